@@ -0,0 +1,93 @@
+"""
+Measures the cold start import cost of the app's entry points, module by module.
+
+Every entry point (Home.py and each page) has its top level imports replayed in a fresh interpreter
+under `python -X importtime`, after importing streamlit, which the Streamlit server has always loaded.
+
+Usage:
+    python -m benchmarks.import_times
+    python -m benchmarks.import_times --top 15 --output import_times.json
+"""
+import os
+import re
+import ast
+import sys
+import json
+import glob
+import argparse
+import subprocess
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+BASELINE_IMPORT = 'import streamlit'
+
+
+def get_entry_points(root: str) -> list[str]:
+    return [os.path.join(root, 'Home.py'), *sorted(glob.glob(os.path.join(root, 'pages', '*.py')))]
+
+def get_top_level_imports(script_path: str) -> list[str]:
+    """Returns the import statements at the top level of a script, as source code."""
+    with open(script_path) as f:
+        source = f.read()
+    tree = ast.parse(source)
+    return [ast.get_source_segment(source, node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+def measure_imports(statements: list[str], root: str) -> list[dict]:
+    """
+    Runs the import statements in a fresh interpreter under -X importtime.
+
+    Returns:
+        list[dict]: One entry per module first imported by the statements, with its self and cumulative time in ms
+            and its nesting depth (0 for the modules imported directly by the statements).
+    """
+    code = "\n".join([BASELINE_IMPORT, "import sys; sys.stderr.write('--- baseline done\\n')", *statements])
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], cwd=root, capture_output=True, text=True, check=True,
+        env={**os.environ, 'PYTHONPATH': root},
+    )
+    lines = completed.stderr.split('--- baseline done\n', 1)[-1].splitlines()
+    modules = []
+    for line in lines:
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append({'module': name, 'self_ms': int(self_us) / 1000, 'cumulative_ms': int(cumulative_us) / 1000, 'depth': (len(indent) - 1) // 2})
+    return modules
+
+def summarize(modules: list[dict], top: int) -> dict:
+    """Totals the import time and lists the most expensive packages and project modules."""
+    packages = {}
+    for module in modules:
+        package = module['module'].split('.')[0]
+        packages[package] = packages.get(package, 0.0) + module['self_ms']
+    return {
+        'total_ms': sum(module['cumulative_ms'] for module in modules if module['depth'] == 0),
+        'packages': sorted(({'package': name, 'self_ms': ms} for name, ms in packages.items()), key=lambda row: row['self_ms'], reverse=True)[:top],
+        'project_modules': [
+            {'module': module['module'], 'cumulative_ms': module['cumulative_ms']}
+            for module in modules if module['module'].startswith(('utils', 'benchmarks'))
+        ],
+    }
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measures the import cost of every page of the app.")
+    parser.add_argument('--top', type=int, default=10, help="Number of packages listed per entry point")
+    parser.add_argument('--output', help="Write the measurements to this JSON file")
+    args = parser.parse_args(argv)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+    for script_path in get_entry_points(root):
+        name = os.path.relpath(script_path, root)
+        results[name] = summarize(measure_imports(get_top_level_imports(script_path), root), args.top)
+
+        print(f"{name}: {results[name]['total_ms']:.0f} ms of imports on top of streamlit")
+        for row in results[name]['packages']:
+            print(f"    {row['package']:<40} {row['self_ms']:>9.1f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
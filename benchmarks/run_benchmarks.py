@@ -0,0 +1,270 @@
+"""
+Times the project's hot paths on synthetic portfolios, fully offline.
+
+Usage:
+    python -m benchmarks.run_benchmarks --equities 20 --events 200 --days 750 --output results.json
+    python -m benchmarks.run_benchmarks --compare results.json  # Exits with 1 if a benchmark regressed
+    python -m benchmarks.run_benchmarks --fixtures recorded/  # Replays market data recorded from the vendors
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic_portfolios import generate_portfolios, generate_rates, record_stand_in_fixtures
+from utils.base_templates import VALUATION_METHODS
+from utils.exchange_rates_helper import (
+    CURRENCY_MAPPING, FX_HISTORY_START, build_cross_rate_matrix, convert_frame_to_base_currency, convert_to_base_currency,
+    fetch_latest_exchange_rates, get_fred_series_id
+)
+from utils.market_data_helper import GuardedProvider, ReplayProvider, use_provider
+from utils import portfolio_store_helper
+from utils.portfolio_store_helper import (
+    load_portfolio, load_portfolio_catalog, load_portfolios, load_portfolios_from_json, save_portfolio, save_portfolios_to_json
+)
+from utils.report_helper import build_payout_schedule, build_price_chart_data, build_price_chart_points, get_portfolio_cross_rates, summarize_payouts
+
+BENCHMARKS = {}  # Name -> function(context) returning the zero argument callable to time
+
+
+def benchmark(name: str):
+    """Registers a benchmark. The decorated function does the (untimed) setup and returns the callable to time."""
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+def fresh_portfolios(context):
+    """Deep copies of the generated portfolios, so memoized price data does not leak between repeats."""
+    return [portfolio.model_copy(deep=True) for portfolio in context['portfolios'].values()]
+
+for method in VALUATION_METHODS:
+    @benchmark(f"valuation.calculate_value.{method}")
+    def _(context, method=method):
+        portfolios = fresh_portfolios(context)
+        return lambda: [equity.calculate_value(method) for portfolio in portfolios for equity in portfolio.equities.values()]
+
+    @benchmark(f"valuation.calculate_event_values.{method}")
+    def _(context, method=method):
+        portfolios = fresh_portfolios(context)
+        return lambda: [portfolio.calculate_event_values(method) for portfolio in portfolios]
+
+@benchmark("storage.save_portfolios_to_json")
+def _(context):
+    file_path = os.path.join(tempfile.mkdtemp(dir=context['work_dir']), 'portfolios.json')
+    return lambda: save_portfolios_to_json(context['portfolios'], file_path)
+
+@benchmark("storage.load_portfolios_from_json")
+def _(context):
+    file_path = os.path.join(tempfile.mkdtemp(dir=context['work_dir']), 'portfolios.json')
+    save_portfolios_to_json(context['portfolios'], file_path)
+    return lambda: load_portfolios_from_json(file_path)
+
+@benchmark("storage.save_portfolio")
+def _(context):
+    store_path = os.path.join(tempfile.mkdtemp(dir=context['work_dir']), 'portfolios.sqlite')
+    portfolio = next(iter(context['portfolios'].values()))
+    return lambda: save_portfolio(portfolio, store_path)
+
+@benchmark("storage.load_portfolio_catalog")
+def _(context):
+    store_path = os.path.join(tempfile.mkdtemp(dir=context['work_dir']), 'portfolios.sqlite')
+    for portfolio in context['portfolios'].values():
+        save_portfolio(portfolio, store_path)
+    return lambda: load_portfolio_catalog(store_path)
+
+@benchmark("storage.load_portfolio")
+def _(context):
+    store_path = os.path.join(tempfile.mkdtemp(dir=context['work_dir']), 'portfolios.sqlite')
+    portfolio = next(iter(context['portfolios'].values()))
+    save_portfolio(portfolio, store_path)
+    portfolio_store_helper._decoded_portfolios.clear()  # Time decoding, not the in-memory cache
+    return lambda: load_portfolio(portfolio.name, store_path)
+
+@benchmark("storage.load_portfolios")
+def _(context):
+    # Every synthetic portfolio holds the same tickers, their prices are registered and decoded once
+    store_path = os.path.join(tempfile.mkdtemp(dir=context['work_dir']), 'portfolios.sqlite')
+    for portfolio in context['portfolios'].values():
+        save_portfolio(portfolio, store_path)
+    portfolio_store_helper._registered_prices.clear()
+    return lambda: load_portfolios(store_path)
+
+@benchmark("fx.convert_to_base_currency.series")
+def _(context):
+    series = [
+        (equity.historical_prices.to_series(), equity.currency)
+        for portfolio in context['portfolios'].values() for equity in portfolio.equities.values()
+    ]
+    return lambda: [convert_to_base_currency(prices, context['rates'], from_currency=currency, to_currency='EUR') for prices, currency in series]
+
+@benchmark("fx.convert_frame_to_base_currency")
+def _(context):
+    frame = pd.concat([
+        pd.DataFrame({'value': equity.historical_prices.prices, 'currency': equity.currency})
+        for portfolio in context['portfolios'].values() for equity in portfolio.equities.values()
+    ], ignore_index=True)
+    return lambda: convert_frame_to_base_currency(frame, build_cross_rate_matrix(context['rates']), to_currency='EUR')
+
+@benchmark("report.build_price_chart_data")
+def _(context):
+    portfolios = fresh_portfolios(context)
+    return lambda: [
+        build_price_chart_data(portfolio, get_portfolio_cross_rates(portfolio, context['rates'], 'EUR'), 'EUR') for portfolio in portfolios
+    ]
+
+@benchmark("report.build_price_chart_points")
+def _(context):
+    portfolios = fresh_portfolios(context)
+    return lambda: [
+        build_price_chart_points(portfolio, get_portfolio_cross_rates(portfolio, context['rates'], 'EUR'), 'EUR') for portfolio in portfolios
+    ]
+
+@benchmark("report.payout_schedule_and_rollups")
+def _(context):
+    portfolios = fresh_portfolios(context)
+    def run():
+        for portfolio in portfolios:
+            cross_rates = get_portfolio_cross_rates(portfolio, context['rates'], 'EUR')
+            summarize_payouts(build_payout_schedule(portfolio, 'moving_average', cross_rates, 'EUR'), 'EUR')
+    return run
+
+@benchmark("network.get_equity_from_ticker.replay")
+def _(context):
+    from utils.yahoo_search_helper import get_equity_from_ticker
+    os.chdir(tempfile.mkdtemp(dir=context['work_dir']))  # Empty price store, so the full history is "downloaded"
+    return lambda: [get_equity_from_ticker(ticker) for ticker in context['tickers']]
+
+@benchmark("network.fetch_latest_exchange_rates.replay")
+def _(context):
+    os.chdir(tempfile.mkdtemp(dir=context['work_dir']))  # No stored series, so every series is "downloaded"
+    return lambda: fetch_latest_exchange_rates(CURRENCY_MAPPING)
+
+@contextmanager
+def replayed_market_data(context):
+    """
+    Serves every market data request from fixture files: the directory given with --fixtures, otherwise
+    responses of the synthetic stand-ins recorded in the work directory. Nothing is rate limited.
+    """
+    fixture_dir = context['args'].fixtures
+    if fixture_dir is None:
+        fixture_dir = os.path.join(context['work_dir'], 'fixtures')
+        tickers = [f"STAND{index}" for index in range(context['args'].equities)]
+        record_stand_in_fixtures(fixture_dir, tickers, [get_fred_series_id(currency) for currency in CURRENCY_MAPPING], FX_HISTORY_START)
+
+    replay = ReplayProvider(fixture_dir)
+    context['tickers'] = sorted(set(replay.recorded_keys('get_history')) & set(replay.recorded_keys('get_ticker_info')))
+    with use_provider(GuardedProvider(replay, rate_limits={})):
+        yield
+
+def time_benchmark(setup, context, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat + 1):  # The first run is a warm-up
+        run = setup(context)
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    timings = timings[1:]
+    return {
+        'repeat': repeat,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+    }
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run_benchmarks(args) -> dict:
+    context = {
+        'args': args,
+        'portfolios': generate_portfolios(args.portfolios, args.equities, args.events, args.days, seed=args.seed),
+        'rates': generate_rates(('USD', *CURRENCY_MAPPING), seed=args.seed),
+    }
+    results = {}
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        context['work_dir'] = work_dir
+        with replayed_market_data(context):
+            for name, setup in BENCHMARKS.items():
+                if args.filter and args.filter not in name:
+                    continue
+                os.chdir(work_dir)
+                try:
+                    results[name] = time_benchmark(setup, context, args.repeat)
+                finally:
+                    os.chdir(original_dir)
+                print(f"{name:<55} median {results[name]['median'] * 1000:10.2f} ms")
+
+    return {
+        'metadata': {
+            'commit': get_git_commit(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'scale': {'portfolios': args.portfolios, 'equities': args.equities, 'events': args.events, 'days': args.days, 'seed': args.seed},
+        },
+        'results': results,
+    }
+
+def compare_results(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """Prints the median time ratio of every benchmark against a baseline and returns the regressed benchmarks."""
+    if current['metadata']['scale'] != baseline['metadata']['scale']:
+        print("Warning: baseline was recorded at a different scale, ratios are not comparable")
+    regressions = []
+    print(f"\nCompared with {baseline['metadata']['commit'][:10]} ({baseline['metadata']['timestamp']}):")
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        ratio = result['median'] / baseline['results'][name]['median']
+        flag = ' REGRESSION' if ratio > threshold else ''
+        print(f"{name:<55} x{ratio:6.2f}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+def parse_args(args=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the valuation, storage, FX and report hot paths offline.")
+    parser.add_argument('--portfolios', type=int, default=3, help="Number of synthetic portfolios")
+    parser.add_argument('--equities', type=int, default=20, help="Equities per portfolio (N)")
+    parser.add_argument('--events', type=int, default=100, help="Vesting events per equity (M)")
+    parser.add_argument('--days', type=int, default=750, help="Days of price history per equity (K)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic data generator")
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per benchmark")
+    parser.add_argument('--filter', default=None, help="Only run benchmarks whose name contains this string")
+    parser.add_argument('--output', default=None, help="Write the results as JSON to this file")
+    parser.add_argument('--compare', default=None, help="Baseline results JSON file to compare against")
+    parser.add_argument('--fixtures', default=None, help="Replay market data recorded in this directory instead of the synthetic stand-ins")
+    parser.add_argument('--threshold', type=float, default=1.2, help="Median time ratio above which a benchmark counts as regressed")
+    return parser.parse_args(args)
+
+def main(args=None) -> int:
+    args = parse_args(args)
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if compare_results(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
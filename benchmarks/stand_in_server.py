@@ -0,0 +1,217 @@
+"""
+Checks the fetch layer against a local stand-in HTTP server with slow, flaky, throttled and missing endpoints.
+
+The server runs on a free local port, serves synthetic market data from `StandInProvider` and counts the hits
+of every path, so each scenario can check both its outcome and how many upstream requests it made.
+
+Usage:
+    python -m benchmarks.stand_in_server  # Exits with 1 if a scenario does not behave as expected
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from benchmarks.synthetic_portfolios import StandInProvider
+from utils.fetch_helper import FETCH_RETRIES, fetch_json, run_fetches
+from utils.market_data_helper import (
+    MarketDataProvider, fred_series_from_fixture, fred_series_to_fixture, price_history_from_fixture, price_history_to_fixture,
+    use_provider
+)
+
+BROKEN_TICKER = 'BROKEN'  # Its details always fail with a server error
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Routes:
+        /ok                       200 with a small JSON document
+        /slow/<seconds>/<key>     200 after the given delay
+        /flaky/<failures>/<key>   503 for the first `failures` hits of the key, then 200
+        /status/<code>            The given status
+        /history/<ticker>         Price history of the ticker
+        /info/<ticker>            Name, currency and ISIN of the ticker, 503 for BROKEN_TICKER
+        /search/<query>           Quotes matching the query
+        /fred/<series>/<start>    Observations of the FRED series from the start date
+    """
+
+    def do_GET(self):
+        self.server.record_hit(self.path)
+        route, *args = self.path.strip('/').split('/')
+        if route == 'ok':
+            self.send_json({'ok': True})
+        elif route == 'slow':
+            time.sleep(float(args[0]))
+            self.send_json({'ok': True})
+        elif route == 'flaky':
+            hits = self.server.get_hits(self.path)
+            self.send_json({'ok': True} if hits > int(args[0]) else {'error': 'Unavailable'}, 200 if hits > int(args[0]) else 503)
+        elif route == 'status':
+            self.send_json({'status': int(args[0])}, int(args[0]))
+        elif route == 'history':
+            self.send_json(price_history_to_fixture(self.server.provider.get_history(args[0])))
+        elif route == 'info' and args[0] != BROKEN_TICKER:
+            self.send_json(self.server.provider.get_ticker_info(args[0]))
+        elif route == 'info':
+            self.send_json({'error': 'Unavailable'}, 503)
+        elif route == 'search':
+            self.send_json(self.server.provider.search_quotes(args[0]))
+        elif route == 'fred':
+            self.send_json(fred_series_to_fixture(self.server.provider.get_fred_series(args[0], args[1])))
+        else:
+            self.send_json({'error': 'Not found'}, 404)
+
+    def send_json(self, data, status: int = 200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.provider = StandInProvider()
+        self.hits = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def record_hit(self, path: str) -> None:
+        with self.lock:
+            self.hits[path] += 1
+
+    def get_hits(self, path: str) -> int:
+        with self.lock:
+            return self.hits[path]
+
+    def handle_error(self, request, client_address):
+        pass  # Clients abandoning timed out requests close the connection before the response
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, name='stand-in-server', daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHTTPProvider(MarketDataProvider):
+    """Market data provider requesting every response from the stand-in server."""
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def get_history(self, ticker: str, start=None):
+        return price_history_from_fixture(fetch_json(f"{self.url}/history/{ticker}"))
+
+    def get_ticker_info(self, ticker: str) -> dict:
+        return fetch_json(f"{self.url}/info/{ticker}")
+
+    def search_quotes(self, query: str) -> list:
+        return fetch_json(f"{self.url}/search/{query}")
+
+    def get_fred_series(self, series_id: str, start) -> pd.Series:
+        return fred_series_from_fixture(fetch_json(f"{self.url}/fred/{series_id}/{start:%Y-%m-%d}"), series_id)
+
+
+def fetch_path(server: StandInServer, path: str, timeout: float = 5, retries: int = FETCH_RETRIES, backoff: float = 0.05):
+    report = run_fetches({path: lambda: fetch_json(server.url + path, timeout=timeout)}, timeout=timeout, retries=retries, backoff=backoff)
+    return report.outcomes[path]
+
+def check_ok(server):
+    outcome = fetch_path(server, '/ok')
+    return outcome.ok and outcome.attempts == 1, f"{outcome.attempts} attempt(s)"
+
+def check_timeout(server):
+    outcome = fetch_path(server, '/slow/2', timeout=0.3, retries=1)
+    expected = not outcome.ok and outcome.attempts == 2 and outcome.elapsed < 1.5
+    return expected, f"{outcome.attempts} attempt(s) in {outcome.elapsed:.2f}s: {outcome.error}"
+
+def check_flaky(server):
+    outcome = fetch_path(server, '/flaky/2/a')
+    return outcome.ok and server.get_hits('/flaky/2/a') == 3, f"{server.get_hits('/flaky/2/a')} hit(s)"
+
+def check_flaky_exhausted(server):
+    outcome = fetch_path(server, '/flaky/10/b')
+    hits = server.get_hits('/flaky/10/b')
+    return not outcome.ok and hits == 1 + FETCH_RETRIES, f"{hits} hit(s): {outcome.error}"
+
+def check_throttled(server):
+    outcome = fetch_path(server, '/status/429', retries=1)
+    return not outcome.ok and server.get_hits('/status/429') == 2, f"{server.get_hits('/status/429')} hit(s)"
+
+def check_not_found(server):
+    outcome = fetch_path(server, '/status/404')
+    return not outcome.ok and server.get_hits('/status/404') == 1, f"{server.get_hits('/status/404')} hit(s): {outcome.error}"
+
+def check_concurrency(server):
+    paths = [f"/slow/0.3/{index}" for index in range(8)]
+    start = time.perf_counter()
+    report = run_fetches({path: (lambda path=path: fetch_json(server.url + path)) for path in paths}, concurrency=8)
+    elapsed = time.perf_counter() - start
+    return report.complete and elapsed < 1.5, f"8 requests of 0.3s in {elapsed:.2f}s"
+
+def check_bulk_loader(server):
+    from utils.yahoo_search_helper import get_equities_from_tickers
+    tickers = ['STAND0', 'STAND1', BROKEN_TICKER]
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)  # Empty price store, so every ticker is requested
+        try:
+            with use_provider(StandInHTTPProvider(server.url)):
+                equities, errors = get_equities_from_tickers(tickers)
+        finally:
+            os.chdir(cwd)
+    hits = server.get_hits(f"/info/{BROKEN_TICKER}")
+    expected = sorted(equities) == tickers[:2] and list(errors) == [BROKEN_TICKER] and hits == 1 + FETCH_RETRIES
+    return expected, f"{len(equities)} loaded, {len(errors)} failed, {hits} request(s) for the failing ticker"
+
+SCENARIOS = {
+    'ok': check_ok,
+    'timeout': check_timeout,
+    'flaky': check_flaky,
+    'flaky_exhausted': check_flaky_exhausted,
+    'throttled': check_throttled,
+    'not_found': check_not_found,
+    'concurrency': check_concurrency,
+    'bulk_loader': check_bulk_loader,
+}
+
+
+def parse_args(args=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', default='', help='Only run the scenarios whose name contains this text')
+    return parser.parse_args(args)
+
+def main(args=None) -> int:
+    args = parse_args(args)
+    failures = 0
+    with StandInServer() as server:
+        for name, check in SCENARIOS.items():
+            if args.filter not in name:
+                continue
+            expected, details = check(server)
+            failures += not expected
+            print(f"{'ok  ' if expected else 'FAIL'} {name:<16} {details}")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
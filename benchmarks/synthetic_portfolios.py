@@ -0,0 +1,98 @@
+"""
+Generates synthetic portfolios and offline stand-ins for the market data vendors, used by the benchmarks.
+"""
+import zlib
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+from utils.base_templates import Equity, Portfolio, PriceHistory, VestingSchedule
+from utils.market_data_helper import MarketDataProvider, RecordingProvider
+
+SECONDS_PER_DAY = 24 * 60 * 60
+DEFAULT_CURRENCIES = ('USD', 'EUR', 'GBP', 'JPY', 'CHF')
+
+
+def generate_price_history(n_days: int, rng: np.random.Generator, end: datetime) -> PriceHistory:
+    """Generates a business day price history following a geometric Brownian motion."""
+    dates = pd.bdate_range(end=end, periods=n_days)
+    log_returns = rng.normal(0.0003, 0.02, size=n_days)
+    prices = rng.uniform(10, 500) * np.exp(np.cumsum(log_returns))
+    return PriceHistory(dates.asi8 // 10**9, prices)
+
+def generate_equity(index: int, n_events: int, n_days: int, rng: np.random.Generator, end: datetime, currencies=DEFAULT_CURRENCIES) -> Equity:
+    """
+    Generates an equity with `n_days` of prices and `n_events` vesting events around the end of its history.
+    The prices only depend on the index, so portfolios holding the same ticker share its history like real ones.
+    """
+    historical_prices = generate_price_history(n_days, np.random.default_rng([index, n_days]), end)
+    first_vest = historical_prices.timestamps[min(len(historical_prices) - 1, n_days // 2)]
+    vesting_dates = rng.integers(first_vest, int(end.timestamp()) + 3 * 365 * SECONDS_PER_DAY, size=n_events)
+    return Equity(
+        isin=f"XS{index:010d}",
+        ticker=f"SYN{index}",
+        name=f"Synthetic Equity {index}",
+        currency=currencies[index % len(currencies)],
+        latest_price=float(historical_prices.prices[-1]),
+        historical_prices=historical_prices,
+        vesting_events=VestingSchedule(vesting_dates, rng.integers(1, 5000, size=n_events)),
+    )
+
+def generate_portfolio(name: str, n_equities: int, n_events: int, n_days: int, seed: int = 0, end: datetime = datetime(2024, 10, 18)) -> Portfolio:
+    """
+    Generates a portfolio of N equities x M vesting events x K days of price history.
+
+    The same arguments always generate the same portfolio, so results are comparable across commits.
+    """
+    rng = np.random.default_rng(seed)
+    equities = [generate_equity(index, n_events, n_days, rng, end) for index in range(n_equities)]
+    return Portfolio(name=name, equities={equity.name: equity for equity in equities})
+
+def generate_portfolios(n_portfolios: int, n_equities: int, n_events: int, n_days: int, seed: int = 0) -> dict[str, Portfolio]:
+    return {
+        f"Synthetic {index}": generate_portfolio(f"Synthetic {index}", n_equities, n_events, n_days, seed=seed + index)
+        for index in range(n_portfolios)
+    }
+
+def generate_rates(currencies=DEFAULT_CURRENCIES, seed: int = 0) -> dict:
+    """Generates a rates dictionary (units of currency per USD), in the format of fetch_latest_exchange_rates."""
+    rng = np.random.default_rng(seed)
+    return {currency: 1.0 if currency == 'USD' else float(rng.uniform(0.5, 150)) for currency in currencies}
+
+
+class StandInProvider(MarketDataProvider):
+    """Offline stand-in for the market data vendors returning deterministic synthetic data."""
+
+    def __init__(self, n_days: int = 252):
+        self.n_days = n_days
+
+    def get_history(self, ticker: str, start=None) -> PriceHistory:
+        rng = np.random.default_rng(sum(map(ord, ticker)))
+        end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        dates = pd.bdate_range(end=end, periods=self.n_days, tz='America/New_York')
+        if start is not None:
+            dates = dates[dates.tz_localize(None) >= pd.Timestamp(start)]
+        prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, size=len(dates))))
+        return PriceHistory.from_series(pd.Series(prices, index=dates))
+
+    def get_ticker_info(self, ticker: str) -> dict:
+        return {'name': f"Stand-in {ticker}", 'currency': 'USD', 'isin': f"XS{zlib.crc32(ticker.encode()):010d}"}
+
+    def search_quotes(self, query: str) -> list:
+        return [{'symbol': query.upper(), 'shortname': f"Stand-in {query.upper()}", 'isYahooFinance': True}]
+
+    def get_fred_series(self, series_id: str, start=None) -> pd.Series:
+        start = pd.Timestamp(start or datetime.now() - timedelta(days=5 * 365))
+        dates = pd.bdate_range(start=start, end=datetime.now(), name='DATE')
+        rng = np.random.default_rng(sum(map(ord, series_id)))
+        values = rng.uniform(0.5, 150) * np.exp(np.cumsum(rng.normal(0, 0.003, size=len(dates))))
+        return pd.Series(values, index=dates, name=series_id)
+
+def record_stand_in_fixtures(fixture_dir: str, tickers, series_ids, fred_start: datetime) -> None:
+    """Records the stand-in responses for the given tickers and FRED series as fixtures for a ReplayProvider."""
+    recorder = RecordingProvider(StandInProvider(), fixture_dir)
+    for ticker in tickers:
+        recorder.get_history(ticker)
+        recorder.get_ticker_info(ticker)
+    for series_id in series_ids:
+        recorder.get_fred_series(series_id, fred_start)
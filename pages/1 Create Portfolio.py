@@ -1,16 +1,19 @@
 import streamlit as st
-from utils.session_state_helper import load_portfolios_from_json
+from utils.portfolio_store_helper import load_portfolios
 from utils.pages.create_portfolio import display_add_portfolio_page
 from utils.base_templates import Portfolio
+from utils.pages.perf_panel import display_perf_panel
+from utils.perf_helper import start_trace
 
 # Set page configuration
 st.set_page_config(page_title="Portfolio Setup", page_icon="💼")
+trace = start_trace("Create Portfolio")
 
 st.title("Portfolio Creation 💼")
 st.subheader("Add equities with their vesting schedules.")
 
 if 'portfolios' not in st.session_state:
-    st.session_state['portfolios'] = load_portfolios_from_json()
+    st.session_state['portfolios'] = load_portfolios()
 
 # Add new portfolio
 new_portfolio_name = st.text_input("New Portfolio Name")
@@ -33,3 +36,5 @@ if new_portfolio_name:
 
         # Display the add portfolio page for the new portfolio
         display_add_portfolio_page(new_portfolio_name)
+
+display_perf_panel(trace)
@@ -1,9 +1,12 @@
 import streamlit as st
 from utils.pages.display_portfolio import display_report_page, generate_report
 from utils.exchange_rates_helper import CURRENCY_MAPPING
+from utils.pages.perf_panel import display_perf_panel
+from utils.perf_helper import start_trace
 
 # Set page configuration
 st.set_page_config(page_title="Portfolio Report", page_icon="📊")
+trace = start_trace("Portfolio Report")
 
 st.title("Portfolio Report 📊")
 st.subheader("Visualize your selected portfolio and its value.")
@@ -11,3 +14,5 @@ st.subheader("Visualize your selected portfolio and its value.")
 # Call the function to display the report page
 selected_portfolio = display_report_page()
 generate_report(selected_portfolio)
+
+display_perf_panel(trace)
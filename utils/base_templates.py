@@ -1,72 +1,330 @@
-import pandas as pd
+from __future__ import annotations
 
-from typing import List, Dict, Optional
-from pydantic import BaseModel, Field
+import os
+import threading
+import hashlib
+import numpy as np
+
+from typing import Any, List, Dict, Iterable, Optional
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, ValidationInfo, field_serializer, field_validator
+
+from utils.lazy_import_helper import lazy_import
+from utils.perf_helper import count, timed
+
+pd = lazy_import('pandas')  # Only needed once prices are turned into frames
+
+VALUATION_METHODS = ("latest", "average", "moving_average")
+PRICE_WINDOW_DAYS = 180  # Number of price observations used by the average based methods
+
+PRICE_HISTORY_DTYPE = np.dtype([('timestamp', '<i8'), ('price', '<f8')])
+
+class PriceHistory:
+    """Read-only price history stored as parallel, date sorted timestamp (int64) and price (float64) arrays."""
+    __slots__ = ('timestamps', 'prices', '_content_hash', '_prefix_sums')
+
+    def __init__(self, timestamps, prices):
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        prices = np.asarray(prices, dtype=np.float64)
+        if timestamps.shape != prices.shape or timestamps.ndim != 1:
+            raise ValueError("timestamps and prices must be 1-dimensional arrays of the same length")
+
+        if len(timestamps) > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, prices = timestamps[order], prices[order]
+
+        # Keep memory-mapped (read-only) arrays as they are, copy anything the caller could still mutate
+        if timestamps.flags.writeable:
+            timestamps = timestamps.copy()
+            timestamps.setflags(write=False)
+        if prices.flags.writeable:
+            prices = prices.copy()
+            prices.setflags(write=False)
+        self.timestamps = timestamps
+        self.prices = prices
+        self._content_hash = None
+        self._prefix_sums = None
+
+    @classmethod
+    def from_dict(cls, prices_by_timestamp: Dict[Any, float]) -> 'PriceHistory':
+        """Builds a price history from the legacy {timestamp: price} dictionary format."""
+        timestamps = np.fromiter((int(timestamp) for timestamp in prices_by_timestamp.keys()), dtype=np.int64, count=len(prices_by_timestamp))
+        prices = np.fromiter(prices_by_timestamp.values(), dtype=np.float64, count=len(prices_by_timestamp))
+        return cls(timestamps, prices)
+
+    @classmethod
+    def from_series(cls, prices: pd.Series) -> 'PriceHistory':
+        """Builds a price history from a price series indexed by a DatetimeIndex."""
+        index = prices.index.tz_convert('UTC') if prices.index.tz is not None else prices.index
+        return cls(index.asi8 // 10**9, prices.to_numpy(dtype=np.float64))
+
+    @classmethod
+    def load(cls, file_path: str, mmap_mode: Optional[str] = 'r') -> 'PriceHistory':
+        """Loads a price history sidecar (.npy file), memory-mapped by default."""
+        records = np.load(file_path, mmap_mode=mmap_mode)
+        return cls(records['timestamp'], records['price'])
+
+    def save(self, file_path: str) -> None:
+        """Atomically writes the price history to a .npy sidecar file."""
+        records = np.empty(len(self), dtype=PRICE_HISTORY_DTYPE)
+        records['timestamp'] = self.timestamps
+        records['price'] = self.prices
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.save(f, records)
+        os.replace(temp_path, file_path)
+
+    def content_hash(self) -> str:
+        """Returns a stable hash of the price history, used to name its sidecar file and key cached results."""
+        if self._content_hash is None:  # The arrays are read-only, so the hash is computed once
+            digest = hashlib.sha1(np.ascontiguousarray(self.timestamps).tobytes())
+            digest.update(np.ascontiguousarray(self.prices).tobytes())
+            self._content_hash = digest.hexdigest()
+        return self._content_hash
+
+    def prefix_sums(self) -> np.ndarray:
+        """Returns the cumulative sums of the prices with a leading 0, the point-in-time index of the trailing means."""
+        if self._prefix_sums is None:  # Computed once and shared by every equity referencing this history
+            prefix_sums = np.concatenate(([0.0], np.cumsum(self.prices)))
+            prefix_sums.setflags(write=False)
+            self._prefix_sums = prefix_sums
+        return self._prefix_sums
+
+    def trailing_means_before(self, timestamps, window: int = PRICE_WINDOW_DAYS) -> np.ndarray:
+        """Returns the mean of the `window` prices strictly before each timestamp (NaN with fewer prices).
+
+        Uses the prefix sums and `searchsorted`, so each lookup is O(log n).
+        """
+        prefix_sums = self.prefix_sums()
+        n_before = np.searchsorted(self.timestamps, np.asarray(timestamps, dtype=np.int64), side='left')
+        means = np.full(len(n_before), np.nan)
+        has_window = n_before >= window
+        means[has_window] = (prefix_sums[n_before[has_window]] - prefix_sums[n_before[has_window] - window]) / window
+        return means
+
+    def to_dict(self) -> Dict[int, float]:
+        return dict(zip(self.timestamps.tolist(), self.prices.tolist()))
+
+    def to_series(self) -> pd.Series:
+        """Returns the prices as a series indexed by timestamp."""
+        return pd.Series(self.prices, index=self.timestamps)
+
+    def items(self):
+        return zip(self.timestamps.tolist(), self.prices.tolist())
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, PriceHistory):
+            return NotImplemented
+        return np.array_equal(self.timestamps, other.timestamps) and np.array_equal(self.prices, other.prices)
+
+    def __repr__(self) -> str:
+        return f"PriceHistory({len(self)} prices)"
 
 class VestingEvent(BaseModel):
     vesting_date: int = Field(description='Vesting date as timestamp')
     shares_vested: float = Field(description='Number of shares vested on this date')
 
+class VestingSchedule:
+    """
+    Vesting events stored as parallel vesting date (int64 timestamp) and shares vested (float64) arrays.
+
+    The arrays are read-only, every change goes through the bulk methods below and replaces them,
+    so the content hash only has to be recomputed after a change.
+    """
+    __slots__ = ('vesting_dates', 'shares_vested', '_content_hash')
+
+    def __init__(self, vesting_dates=(), shares_vested=()):
+        self._set_arrays(vesting_dates, shares_vested)
+
+    def _set_arrays(self, vesting_dates, shares_vested) -> None:
+        vesting_dates = np.array(vesting_dates, dtype=np.int64, ndmin=1)
+        shares_vested = np.array(shares_vested, dtype=np.float64, ndmin=1)
+        if vesting_dates.shape != shares_vested.shape or vesting_dates.ndim != 1:
+            raise ValueError("vesting_dates and shares_vested must be 1-dimensional arrays of the same length")
+        vesting_dates.setflags(write=False)
+        shares_vested.setflags(write=False)
+        self.vesting_dates = vesting_dates
+        self.shares_vested = shares_vested
+        self._content_hash = None
+
+    @classmethod
+    def from_events(cls, events: Iterable[Any]) -> 'VestingSchedule':
+        """Builds a schedule from VestingEvent objects or the JSON format [{'vesting_date': ..., 'shares_vested': ...}]."""
+        events = [event.model_dump() if isinstance(event, VestingEvent) else event for event in events]
+        return cls(
+            np.fromiter((int(event['vesting_date']) for event in events), dtype=np.int64, count=len(events)),
+            np.fromiter((float(event['shares_vested']) for event in events), dtype=np.float64, count=len(events)),
+        )
+
+    def to_events(self) -> List[Dict[str, Any]]:
+        """Returns the schedule in the JSON format, in the stored order."""
+        return [
+            {'vesting_date': vesting_date, 'shares_vested': shares_vested}
+            for vesting_date, shares_vested in zip(self.vesting_dates.tolist(), self.shares_vested.tolist())
+        ]
+
+    def append(self, vesting_dates, shares_vested) -> None:
+        """Appends one event (scalars) or several events (arrays) at the end of the schedule."""
+        self._set_arrays(
+            np.concatenate((self.vesting_dates, np.array(vesting_dates, dtype=np.int64, ndmin=1))),
+            np.concatenate((self.shares_vested, np.array(shares_vested, dtype=np.float64, ndmin=1))),
+        )
+
+    def delete(self, indices) -> None:
+        """Deletes the events at the given positions (an index, a list of indices or a boolean mask)."""
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        self._set_arrays(np.delete(self.vesting_dates, indices), np.delete(self.shares_vested, indices))
+
+    def sort(self) -> None:
+        """Sorts the events by vesting date, keeping the order of events vesting on the same date."""
+        order = np.argsort(self.vesting_dates, kind='stable')
+        self._set_arrays(self.vesting_dates[order], self.shares_vested[order])
+
+    def merge_duplicates(self) -> None:
+        """Sorts the events by vesting date and merges events vesting on the same date into one."""
+        vesting_dates, positions = np.unique(self.vesting_dates, return_inverse=True)
+        self._set_arrays(vesting_dates, np.bincount(positions.ravel(), weights=self.shares_vested, minlength=len(vesting_dates)))
+
+    def content_hash(self) -> str:
+        if self._content_hash is None:
+            digest = hashlib.sha1(self.vesting_dates.tobytes())
+            digest.update(self.shares_vested.tobytes())
+            self._content_hash = digest.hexdigest()
+        return self._content_hash
+
+    def __len__(self) -> int:
+        return len(self.vesting_dates)
+
+    def __iter__(self):
+        for vesting_date, shares_vested in zip(self.vesting_dates.tolist(), self.shares_vested.tolist()):
+            yield VestingEvent.model_construct(vesting_date=vesting_date, shares_vested=shares_vested)
+
+    def __getitem__(self, index: int) -> VestingEvent:
+        return VestingEvent.model_construct(vesting_date=int(self.vesting_dates[index]), shares_vested=float(self.shares_vested[index]))
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, VestingSchedule):
+            return NotImplemented
+        return np.array_equal(self.vesting_dates, other.vesting_dates) and np.array_equal(self.shares_vested, other.shares_vested)
+
+    def __repr__(self) -> str:
+        return f"VestingSchedule({len(self)} events)"
+
 class Equity(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     isin: Optional[str] = Field(default=None, description='ISIN of the equity', example='US9311421039')
     ticker: Optional[str] = Field(default=None, description='Ticker of the equity', example='WMT')
     name: Optional[str] = Field(default=None, description='Name of the equity', example='Walmart')
     currency: Optional[str] = Field(default=None, description='Currency of the equity', example='USD')
     latest_price: Optional[float] = Field(default=None, description='Latest market price of the equity', example=150.25)
-    historical_prices: Optional[Dict[int, float]] = Field(default=None, description='Dictionary of historical prices by date (timestamp as int)')
-    vesting_events: List[VestingEvent] = Field(default=[], description='List of vesting events for the equity')
+    historical_prices: Optional[PriceHistory] = Field(default=None, description='Historical prices by date (timestamp as int)')
+    vesting_events: VestingSchedule = Field(default_factory=VestingSchedule, description='Vesting events of the equity')
 
-    def calculate_value(self, method: str = "average") -> Optional[float]:
-        """Calculates the total value of the equity based on vesting events and different price methods."""
-        if not self.vesting_events:
-            return None
+    # Memoized price statistics, cleared whenever a price field is reassigned
+    _price_cache: dict = PrivateAttr(default_factory=dict)
 
-        # Convert historical_prices dict to DataFrame for easier manipulation
-        historical_df = self._get_historical_prices_df()
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name in ('historical_prices', 'latest_price'):
+            self._price_cache.clear()
 
-        total_value = 0
+    def __eq__(self, other: Any) -> bool:
+        # Compare fields only, memoized price data must not affect equality
+        if not isinstance(other, Equity):
+            return NotImplemented
+        return self.__dict__ == other.__dict__
 
-        for event in self.vesting_events:
-            shares_vested = event.shares_vested
+    @field_validator('historical_prices', mode='before')
+    @classmethod
+    def _parse_historical_prices(cls, value: Any, info: ValidationInfo) -> Optional[PriceHistory]:
+        """Accepts a PriceHistory, a sidecar reference ({'sidecar': path}) or the legacy {timestamp: price} dictionary."""
+        if value is None or isinstance(value, PriceHistory):
+            return value
+        if isinstance(value, dict) and 'sidecar' in value:
+            sidecar_dir = (info.context or {}).get('sidecar_dir', '')
+            return PriceHistory.load(os.path.join(sidecar_dir, value['sidecar']))
+        if isinstance(value, dict):
+            return PriceHistory.from_dict(value)
+        raise ValueError(f"Unsupported historical prices format: {type(value).__name__}")
 
-            if method == "latest":
-                total_value += shares_vested * self.latest_price if self.latest_price else 0
+    @field_serializer('historical_prices', when_used='json')
+    def _serialize_historical_prices(self, value: Optional[PriceHistory]) -> Optional[Dict[int, float]]:
+        return value.to_dict() if value is not None else None
 
-            elif method == "average" and not historical_df.empty:
-                # Calculate average price over the last 180 days
-                last_180_days = historical_df.tail(180)
-                if not last_180_days.empty:
-                    avg_price_180_days = last_180_days['price'].mean()
-                    total_value += shares_vested * avg_price_180_days
+    @field_validator('vesting_events', mode='before')
+    @classmethod
+    def _parse_vesting_events(cls, value: Any) -> VestingSchedule:
+        """Accepts a VestingSchedule or a list of VestingEvent objects / {'vesting_date', 'shares_vested'} dictionaries."""
+        if isinstance(value, VestingSchedule):
+            return value
+        if value is None:
+            return VestingSchedule()
+        if isinstance(value, (list, tuple)):
+            return VestingSchedule.from_events(value)
+        raise ValueError(f"Unsupported vesting events format: {type(value).__name__}")
 
-            elif method == "moving_average":
-                # Calculate the 180-day moving average leading up to the vesting date
-                historical_df['moving_avg'] = historical_df['price'].rolling(window=180).mean()
+    @field_serializer('vesting_events')
+    def _serialize_vesting_events(self, value: VestingSchedule) -> List[Dict[str, Any]]:
+        # Always serialized as a list, the stored JSON format is unchanged
+        return value.to_events()
 
-                # Convert vesting date from timestamp to datetime
-                vesting_date_dt = pd.to_datetime(event.vesting_date, unit='s')
+    def get_valuation_fingerprint(self) -> tuple:
+        """Returns everything the value of the equity's vesting events depends on, to detect modified equities."""
+        return (
+            self.name,
+            self.ticker,
+            self.currency,
+            self.latest_price,
+            self.historical_prices.content_hash() if self.historical_prices else None,
+            self.vesting_events.content_hash(),
+        )
 
-                # Get relevant prices leading up to the vesting date
-                relevant_prices = historical_df[historical_df.index < vesting_date_dt]
+    def calculate_value(self, method: str = "average", window: int = PRICE_WINDOW_DAYS) -> Optional[float]:
+        """Calculates the total value of the equity based on vesting events and different price methods."""
+        if not self.vesting_events:
+            return None
 
-                if not relevant_prices.empty and len(relevant_prices) >= 180:
-                    # Use the last moving average value
-                    moving_avg_value = relevant_prices['moving_avg'].iloc[-1]
-                    total_value += shares_vested * moving_avg_value if pd.notna(moving_avg_value) else 0
+        event_values = calculate_event_values([self], method=method, window=window)
+        total_value = event_values['value'].sum()  # NaN values (no price available) are skipped
 
         return total_value if total_value > 0 else None
 
-    def _get_historical_prices_df(self) -> pd.DataFrame:
-        """Helper method to convert historical prices (dictionary) into a DataFrame."""
+    def _cached(self, key, compute):
+        """Helper method returning the memoized result of `compute` for the current prices."""
+        if key not in self._price_cache:
+            count('cache.equity_prices.miss')
+            self._price_cache[key] = compute()
+        else:
+            count('cache.equity_prices.hit')
+        return self._price_cache[key]
+
+    def _get_price_arrays(self) -> tuple[np.ndarray, np.ndarray]:
+        """Helper method returning the historical prices as date sorted (timestamp, price) arrays."""
         if not self.historical_prices:
-            return pd.DataFrame()  # Return an empty DataFrame if no historical prices
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return self.historical_prices.timestamps, self.historical_prices.prices
 
-        # Create DataFrame from historical prices dictionary
-        prices_df = pd.DataFrame(list(self.historical_prices.items()), columns=["timestamp", "price"])
-        prices_df["date"] = pd.to_datetime(prices_df["timestamp"], unit='s')  # Convert timestamp to datetime
-        prices_df.set_index("date", inplace=True)
-        return prices_df.sort_index()  # Ensure the data is sorted by date
+    def trailing_mean(self, window: int = PRICE_WINDOW_DAYS) -> Optional[float]:
+        """Returns the (memoized) mean of the last `window` historical prices, or None without prices."""
+        def compute():
+            _, prices = self._get_price_arrays()
+            return float(prices[-window:].mean()) if len(prices) else None
+        return self._cached(('trailing_mean', window), compute)
 
+    def trailing_means_before(self, timestamps: np.ndarray, window: int = PRICE_WINDOW_DAYS) -> np.ndarray:
+        """Returns the mean of the `window` prices strictly before each timestamp (NaN with fewer prices).
+
+        Lookups go through the index of the (possibly shared) price history, see `PriceHistory.trailing_means_before`.
+        """
+        if not self.historical_prices:
+            return np.full(len(timestamps), np.nan)
+        return self.historical_prices.trailing_means_before(timestamps, window)
 
 class Portfolio(BaseModel):
     name: str = Field(
@@ -77,5 +335,76 @@ class Portfolio(BaseModel):
         default_factory=dict, 
         description='Dictionary of equities with ticker as key'
     )
+
     def to_json(self):
-        return self.json(indent=4)  # Converts the portfolio to a JSON string with indentation for readability
\ No newline at end of file
+        return self.json(indent=4)  # Converts the portfolio to a JSON string with indentation for readability
+
+    def get_modified_equities(self, fingerprints: dict[str, tuple]) -> tuple[list[str], list[str]]:
+        """
+        Compares the equities with the fingerprints taken at a previous valuation.
+
+        Returns:
+            tuple[list[str], list[str]]: The keys of the equities added or modified since, and the keys of the removed equities.
+        """
+        modified = [key for key, equity in self.equities.items() if fingerprints.get(key) != equity.get_valuation_fingerprint()]
+        removed = [key for key in fingerprints if key not in self.equities]
+        return modified, removed
+
+    def calculate_event_values(self, method: str = "average", window: int = PRICE_WINDOW_DAYS) -> pd.DataFrame:
+        """Returns the value of every vesting event in the portfolio (see `calculate_event_values`)."""
+        return calculate_event_values(self.equities.values(), method=method, window=window)
+
+@timed('valuation.calculate_event_values')
+def calculate_event_values(equities: Iterable[Equity], method: str = "average", window: int = PRICE_WINDOW_DAYS) -> pd.DataFrame:
+    """Values every vesting event of the given equities in one vectorized pass per equity.
+
+    Args:
+        equities (Iterable[Equity]): The equities whose vesting events should be valued.
+        method (str): One of 'latest', 'average' or 'moving_average'.
+        window (int): Number of price observations used by the average based methods.
+
+    Returns:
+        pd.DataFrame: One row per vesting event with the columns 'equity', 'ticker', 'currency',
+            'vesting_date' (timestamp), 'shares_vested', 'price' and 'value'. Price and value
+            are NaN when the method has no price available for the event.
+    """
+    if method not in VALUATION_METHODS:
+        raise ValueError(f"Unknown valuation method '{method}', expected one of {VALUATION_METHODS}")
+
+    frames = []
+    for equity in equities:
+        if not equity.vesting_events:
+            continue
+
+        vesting_dates = equity.vesting_events.vesting_dates
+        shares_vested = equity.vesting_events.shares_vested
+        event_prices = np.full(len(vesting_dates), np.nan)
+
+        if method == "latest":
+            if equity.latest_price:
+                event_prices[:] = equity.latest_price
+
+        elif method == "average":
+            # Average price over the last `window` observations, identical for every event
+            trailing_mean = equity.trailing_mean(window)
+            if trailing_mean is not None:
+                event_prices[:] = trailing_mean
+
+        elif method == "moving_average":
+            # Trailing `window` mean of the prices strictly before each vesting date,
+            # computed from prefix sums instead of a rolling window per event
+            event_prices = equity.trailing_means_before(vesting_dates, window)
+
+        frames.append(pd.DataFrame({
+            'equity': equity.name,
+            'ticker': equity.ticker,
+            'currency': equity.currency,
+            'vesting_date': vesting_dates,
+            'shares_vested': shares_vested,
+            'price': event_prices,
+            'value': shares_vested * event_prices,
+        }))
+
+    if not frames:
+        return pd.DataFrame(columns=['equity', 'ticker', 'currency', 'vesting_date', 'shares_vested', 'price', 'value'])
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,125 @@
+"""
+Values portfolios without the Streamlit UI and writes their payout schedules and totals to disk.
+
+Usage:
+    python -m utils.batch_valuation --method average --base-currency EUR --output-dir reports/
+    python -m utils.batch_valuation "Alvin" "Jane Doe" --format parquet --workers 4
+"""
+import os
+import re
+import json
+import hashlib
+import argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Optional
+
+from utils.base_templates import VALUATION_METHODS
+from utils.exchange_rates_helper import CURRENCY_MAPPING, fetch_latest_exchange_rates
+from utils.portfolio_store_helper import PORTFOLIO_STORE_PATH, load_portfolio, load_portfolio_catalog
+from utils.report_helper import value_portfolio
+
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+
+def get_output_file_name(portfolio_name: str, method: str, base_currency: str, output_format: str) -> str:
+    safe_name = re.sub(r'[^\w.-]+', '_', portfolio_name).strip('_') or 'portfolio'
+    if safe_name != portfolio_name:
+        # Names changed by the sanitising could collide (e.g. "A B" and "A_B"), tell them apart by the original name
+        safe_name = f"{safe_name}-{hashlib.sha1(portfolio_name.encode()).hexdigest()[:8]}"
+    return f"{safe_name}_{method}_{base_currency}_payouts.{output_format}"
+
+def write_frame(frame: pd.DataFrame, file_path: str, output_format: str) -> None:
+    if output_format == 'parquet':
+        frame.to_parquet(file_path, index=False)  # Requires pyarrow or fastparquet
+    else:
+        frame.to_csv(file_path, index=False)
+
+def value_portfolio_to_file(portfolio_name: str, method: str, base_currency: str, rates: dict, output_dir: str, output_format: str, store_path: str=PORTFOLIO_STORE_PATH) -> dict:
+    """
+    Values a single stored portfolio and writes its payout schedule. Runs inside a worker process.
+
+    Returns:
+        dict: The portfolio's summary row for the totals file.
+    """
+    portfolio = load_portfolio(portfolio_name, store_path)
+    if portfolio is None:
+        raise ValueError(f"Portfolio '{portfolio_name}' not found in {store_path}")
+
+    report = value_portfolio(portfolio, method, base_currency, rates)
+    file_path = os.path.join(output_dir, get_output_file_name(portfolio_name, method, base_currency, output_format))
+    write_frame(report.payout_schedule.assign(Portfolio=portfolio_name), file_path, output_format)
+    return {
+        'Portfolio': portfolio_name,
+        'Method': method,
+        'Base Currency': base_currency,
+        'Vesting Events': len(report.payout_schedule),
+        'Total Value': report.total_value,
+        'Payout File': os.path.basename(file_path),
+    }
+
+def run_batch_valuation(portfolio_names: list[str], method: str, base_currency: str, rates: dict, output_dir: str, output_format: str='csv', workers: Optional[int]=None, store_path: str=PORTFOLIO_STORE_PATH) -> tuple[pd.DataFrame, dict[str, str]]:
+    """
+    Values the given portfolios across a process pool.
+
+    Returns:
+        tuple[pd.DataFrame, dict[str, str]]: The totals per portfolio (also written to the output
+            directory) and the error message of every portfolio that could not be valued.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    totals, errors = [], {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(value_portfolio_to_file, name, method, base_currency, rates, output_dir, output_format, store_path): name
+            for name in portfolio_names
+        }
+        for future in as_completed(futures):
+            try:
+                totals.append(future.result())
+            except Exception as e:
+                errors[futures[future]] = str(e) or type(e).__name__
+
+    order = {name: position for position, name in enumerate(portfolio_names)}
+    totals_df = pd.DataFrame(totals, columns=['Portfolio', 'Method', 'Base Currency', 'Vesting Events', 'Total Value', 'Payout File'])
+    totals_df = totals_df.sort_values('Portfolio', key=lambda names: names.map(order)).reset_index(drop=True)
+    write_frame(totals_df, os.path.join(output_dir, f"totals_{method}_{base_currency}.{output_format}"), output_format)
+    return totals_df, errors
+
+def parse_args(args=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Value stored portfolios and write their payout schedules and totals.")
+    parser.add_argument('portfolios', nargs='*', help="Names of the portfolios to value (default: every stored portfolio)")
+    parser.add_argument('--method', choices=VALUATION_METHODS, default='average', help="Valuation method (default: average)")
+    parser.add_argument('--base-currency', choices=['USD', *CURRENCY_MAPPING], default='USD', help="Currency to report in (default: USD)")
+    parser.add_argument('--output-dir', default=f"reports/{datetime.now().date()}", help="Directory for the output files")
+    parser.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS, default='csv', help="Output file format (default: csv)")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--store', default=PORTFOLIO_STORE_PATH, help=f"Portfolio store to read from (default: {PORTFOLIO_STORE_PATH})")
+    parser.add_argument('--rates-file', default=None, help="JSON file of exchange rates to use instead of fetching the latest rates")
+    return parser.parse_args(args)
+
+def main(args=None) -> int:
+    args = parse_args(args)
+    portfolio_names = args.portfolios or [entry['name'] for entry in load_portfolio_catalog(args.store)]
+    if not portfolio_names:
+        print(f"No portfolios found in {args.store}")
+        return 1
+
+    if args.rates_file:
+        with open(args.rates_file, 'r') as f:
+            rates = json.load(f)
+    else:
+        rates = fetch_latest_exchange_rates()
+
+    totals_df, errors = run_batch_valuation(
+        portfolio_names, args.method, args.base_currency, rates, args.output_dir, args.output_format, args.workers, args.store
+    )
+    print(totals_df.to_string(index=False))
+    for name, error in errors.items():
+        print(f"Error valuing portfolio '{name}': {error}")
+    print(f"Wrote {len(totals_df)} payout schedules to {args.output_dir}")
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import numpy as np
+
+from utils.lazy_import_helper import lazy_import
+
+pd = lazy_import('pandas')
+
+CHART_POINT_BUDGET = 500  # Points kept per line chart series
+CHART_BAR_BUDGET = 200  # Bars kept in a bar chart
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling: returns the indices of the `n_out` points that best
+    preserve the visual shape of the (x sorted) series. The first and last points are always kept.
+    """
+    n = len(x)
+    if n_out >= n:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1])[:max(n_out, 0)]
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # Inner points are split into n_out - 2 buckets, one point is kept per bucket
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+
+    # Average point of the bucket following each bucket (the last point for the last bucket)
+    next_starts = np.append(edges[1:-1], n - 1)
+    next_ends = np.append(edges[2:], n)
+    prefix_x = np.concatenate(([0.0], np.cumsum(x)))
+    prefix_y = np.concatenate(([0.0], np.cumsum(y)))
+    next_x = ((prefix_x[next_ends] - prefix_x[next_starts]) / (next_ends - next_starts)).tolist()
+    next_y = ((prefix_y[next_ends] - prefix_y[next_starts]) / (next_ends - next_starts)).tolist()
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket, (start, end) in enumerate(zip(edges[:-1].tolist(), edges[1:].tolist())):
+        # Keep the point forming the largest triangle with the previously kept point and the next average
+        previous_x, previous_y = x[previous], y[previous]
+        areas = np.abs((previous_x - next_x[bucket]) * (y[start:end] - previous_y) - (previous_x - x[start:end]) * (next_y[bucket] - previous_y))
+        previous = start + int(areas.argmax())
+        selected[bucket + 1] = previous
+    return selected
+
+def downsample_wide_frame(frame: pd.DataFrame, max_points: int = CHART_POINT_BUDGET, value_name: str = 'Value') -> pd.DataFrame:
+    """
+    Downsamples every column of a date indexed wide frame with LTTB and returns the kept points in long format,
+    with the index name, the columns name and `value_name` as columns (e.g. for `st.line_chart(x=, y=, color=)`).
+    """
+    index_name = frame.index.name or 'Date'
+    columns_name = frame.columns.name or 'Series'
+    long_frames = []
+    for column in frame.columns:
+        series = frame[column].dropna()
+        if series.empty:
+            continue
+        keep = lttb_indices(series.index.asi8 if isinstance(series.index, pd.DatetimeIndex) else series.index.to_numpy(), series.to_numpy(), max_points)
+        long_frames.append(pd.DataFrame({index_name: series.index[keep], columns_name: column, value_name: series.to_numpy()[keep]}))
+
+    if not long_frames:
+        return pd.DataFrame(columns=[index_name, columns_name, value_name])
+    return pd.concat(long_frames, ignore_index=True)
+
+def bucket_sums(frame: pd.DataFrame, date_column: str, value_column: str, max_bars: int = CHART_BAR_BUDGET) -> pd.DataFrame:
+    """
+    Sums the values of a dated frame into at most `max_bars` equal width time buckets, each labelled by its first date.
+
+    Unlike point downsampling this preserves the total, which is what a bar chart of amounts should show.
+    """
+    if len(frame) <= max_bars:
+        return frame[[date_column, value_column]].reset_index(drop=True)
+
+    timestamps = frame[date_column].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    edges = np.linspace(timestamps.min(), timestamps.max(), max_bars + 1)
+    buckets = np.clip(np.searchsorted(edges, timestamps, side='right') - 1, 0, max_bars - 1)
+    sums = np.bincount(buckets, weights=frame[value_column].to_numpy(dtype=float), minlength=max_bars)
+    first_dates = np.full(max_bars, np.iinfo(np.int64).max)
+    np.minimum.at(first_dates, buckets, timestamps)
+    non_empty = np.bincount(buckets, minlength=max_bars) > 0
+    return pd.DataFrame({
+        date_column: pd.to_datetime(first_dates[non_empty]),
+        value_column: sums[non_empty],
+    })
@@ -1,7 +1,18 @@
+from __future__ import annotations
+
 import os
 import json
-import pandas_datareader.data as web
-from datetime import datetime
+import threading
+import functools
+from datetime import datetime, timedelta
+from typing import Optional
+
+from utils.fetch_helper import run_fetches
+from utils.lazy_import_helper import lazy_import
+from utils.market_data_helper import get_provider
+from utils.perf_helper import count, timed
+
+pd = lazy_import('pandas')
 
 CURRENCY_MAPPING = {
     'EUR': 'USEU',  # Euro
@@ -19,6 +30,20 @@ CURRENCY_MAPPING = {
     'ZAR': 'SFUS'   # South African Rand
 }
 
+# FRED 'DEXUS..' series are quoted in USD per unit of the currency, all others in units per USD
+USD_QUOTED_CURRENCIES = {'EUR', 'GBP', 'AUD', 'NZD'}
+FX_SERIES_DIR = 'data/exchange_rates/series'
+FX_HISTORY_START = datetime(2015, 1, 1)  # First date fetched for a series without stored history
+FX_FETCH_WORKERS = 8  # Series refreshed at the same time
+FX_FAILED_RETRY_AFTER = timedelta(hours=1)  # Wait before fetching a currency again after it failed to load
+
+def get_fred_series_id(currency: str, currency_mapping=CURRENCY_MAPPING) -> str:
+    return f'DEX{currency_mapping[currency]}'
+
+def to_units_per_usd(values, currency: str):
+    """Converts FRED quotes into units of the currency per USD, the convention used by the rates dictionaries."""
+    return 1 / values if currency in USD_QUOTED_CURRENCIES else values
+
 def save_rates_to_json(rates):
     """Saves the exchange rates to a JSON file."""
     filename = f"data/exchange_rates/{datetime.now().date()}.json"
@@ -34,30 +59,147 @@ def load_rates_from_json():
             return json.load(f)
     return None
 
+def load_failed_currencies() -> dict:
+    """Loads the currencies that failed to load today, with the time of their last failure."""
+    filename = f"data/exchange_rates/{datetime.now().date()}.failed.json"
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            return {currency: datetime.fromisoformat(failed_at) for currency, failed_at in json.load(f).items()}
+    return {}
+
+def save_failed_currencies(failed_currencies: dict) -> None:
+    """Saves the currencies that failed to load today next to today's rates, so reports do not fetch them again."""
+    filename = f"data/exchange_rates/{datetime.now().date()}.failed.json"
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump({currency: failed_at.isoformat() for currency, failed_at in failed_currencies.items()}, f)
+
+def get_fx_series_path(series_id: str, series_dir: str = FX_SERIES_DIR) -> str:
+    return os.path.join(series_dir, f"{series_id}.csv")
+
+def load_fx_series(series_id: str, series_dir: str = FX_SERIES_DIR) -> pd.Series:
+    """Loads the stored daily observations of a FRED series (raw FRED quotes), empty if none are stored."""
+    path = get_fx_series_path(series_id, series_dir)
+    if not os.path.exists(path):
+        return pd.Series(dtype=float, name=series_id, index=pd.DatetimeIndex([], name='DATE'))
+    return pd.read_csv(path, index_col='DATE', parse_dates=['DATE'])[series_id]
+
+def save_fx_series(series: pd.Series, series_dir: str = FX_SERIES_DIR) -> None:
+    """Atomically writes the observations of a FRED series to disk."""
+    path = get_fx_series_path(series.name, series_dir)
+    os.makedirs(series_dir, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    series.rename_axis('DATE').to_csv(temp_path, header=True)
+    os.replace(temp_path, path)
+
+@timed('fx.refresh_fx_series')
+def refresh_fx_series(series_id: str, series_dir: str = FX_SERIES_DIR) -> pd.Series:
+    """
+    Appends the observations published since the last stored one to a FRED series and returns the full history.
+    Series already refreshed today are returned from disk without a network call.
+    """
+    stored = load_fx_series(series_id, series_dir)
+    path = get_fx_series_path(series_id, series_dir)
+    if not stored.empty and datetime.fromtimestamp(os.path.getmtime(path)).date() == datetime.now().date():
+        return stored
+
+    start = stored.index[-1] + timedelta(days=1) if not stored.empty else FX_HISTORY_START
+    if start.date() > datetime.now().date():
+        return stored
+
+    try:
+        new_observations = get_provider().get_fred_series(series_id, start)
+    except Exception as e:
+        if stored.empty:
+            raise
+        print(f"Error refreshing {series_id}, using stored observations: {e}")
+        return stored
+
+    if not stored.empty:
+        new_observations = new_observations[new_observations.index > stored.index[-1]]
+    series = pd.concat([stored, new_observations]) if not stored.empty else new_observations
+    series = series.rename(series_id).rename_axis('DATE')
+    save_fx_series(series, series_dir)  # Also marks the series as refreshed today
+    return series
+
+@timed('fx.refresh_fx_history')
+def refresh_fx_history(currencies, currency_mapping=CURRENCY_MAPPING, max_workers: int = FX_FETCH_WORKERS) -> pd.DataFrame:
+    """
+    Refreshes the FRED series of the given currencies concurrently, with a timeout and retries per series.
+
+    Returns:
+        pd.DataFrame: Daily rates in units of currency per USD, one column per currency (including USD),
+            forward filled over days without an observation. Currencies that failed to load are left out.
+    """
+    currencies = [currency for currency in dict.fromkeys(currencies) if currency in currency_mapping and currency != 'USD']
+    report = run_fetches(
+        {currency: functools.partial(refresh_fx_series, get_fred_series_id(currency, currency_mapping)) for currency in currencies},
+        concurrency=max_workers,
+    )
+    for currency, error in report.errors.items():
+        print(f"Error fetching exchange rate for {currency}: {error}")
+    columns = {currency: to_units_per_usd(series, currency) for currency, series in report.values.items() if not series.empty}
+
+    history = pd.DataFrame({currency: columns[currency] for currency in currencies if currency in columns}).sort_index().ffill()
+    history.insert(0, 'USD', 1.0)
+    return history
+
+def get_rates_as_of(date, currencies=CURRENCY_MAPPING, fx_history: Optional[pd.DataFrame] = None) -> dict:
+    """
+    Returns the exchange rates (units per USD) in effect on a given date, i.e. the last observation on or before it.
+
+    Args:
+        date (datetime, str or timestamp): The date to look the rates up for.
+        currencies (iterable): The currencies to return rates for.
+        fx_history (pd.DataFrame): Optional result of `refresh_fx_history`, to avoid reloading the series.
+    """
+    if fx_history is None:
+        fx_history = refresh_fx_history(currencies)
+    position = fx_history.index.searchsorted(pd.Timestamp(date), side='right') - 1
+    if position < 0:
+        return {"USD": 1}
+    rates = fx_history.iloc[position].dropna()
+    currencies = set(currencies) | {'USD'}
+    return {currency: float(rate) for currency, rate in rates.items() if currency in currencies}
+
+@timed('fx.fetch_latest_exchange_rates')
 def fetch_latest_exchange_rates(currency_mapping=CURRENCY_MAPPING):
-    """Fetches the latest exchange rates for given currencies against USD."""
-    rates = {"USD": 1}
-    
-    # First, check if rates are already available in the JSON file
-    existing_rates = load_rates_from_json()
-    if existing_rates:
+    """Fetches the latest exchange rates for given currencies against USD.
+
+    Only the requested currencies missing from today's snapshot are refreshed, and merged into the snapshot.
+    Currencies that fail to load are recorded for the day and only fetched again after FX_FAILED_RETRY_AFTER.
+
+    Args:
+        currency_mapping (iterable): The currencies to fetch, CURRENCY_MAPPING (all supported currencies) by default.
+    """
+    currencies = [currency for currency in currency_mapping if currency in CURRENCY_MAPPING]
+
+    # First, check if today's rates are already available in the JSON file
+    existing_rates = load_rates_from_json() or {}
+    failed_currencies = load_failed_currencies()
+    retry_before = datetime.now() - FX_FAILED_RETRY_AFTER
+    missing_currencies = [
+        currency for currency in currencies
+        if currency not in existing_rates and failed_currencies.get(currency, retry_before) <= retry_before
+    ]
+    if not missing_currencies:
+        count('cache.fx_snapshot.hit')
         return existing_rates  # Return the existing rates if found
+    count('cache.fx_snapshot.miss')
 
-    for currency in currency_mapping:
-        if currency != "USD":
-            try:
-                # Fetch the latest exchange rate from FRED
-                exchange_rate = web.get_data_fred(f'DEX{currency_mapping[currency]}').iloc[-1]
-                if currency in {'EUR', 'NZD', 'GPB'}:
-                    rates[currency] = round(1/exchange_rate.iloc[0], 4)  # Get the latest rate
-                else:
-                    rates[currency] = exchange_rate.iloc[0]  # Get the latest rate
-                    
-            except Exception as e:
-                print(f"Error fetching exchange rate for {currency}: {e}")
-
-    # Save the fetched rates to a JSON file
+    # Refresh the stored series of the missing currencies concurrently and keep the last observation of each
+    fx_history = refresh_fx_history(missing_currencies)
+    rates = {**existing_rates, **{
+        currency: float(fx_history[currency].dropna().iloc[-1]) for currency in fx_history.columns if fx_history[currency].notna().any()
+    }}
+
+    # Save the merged rates to today's JSON file
     save_rates_to_json(rates)
+    newly_failed = {currency: datetime.now() for currency in missing_currencies if currency not in rates}
+    if newly_failed or failed_currencies:
+        save_failed_currencies({
+            currency: failed_at for currency, failed_at in {**failed_currencies, **newly_failed}.items() if currency not in rates
+        })
     return rates
 
 def convert_to_base_currency(prices, rates, from_currency='USD', to_currency='USD'):
@@ -92,3 +234,48 @@ def convert_to_base_currency(prices, rates, from_currency='USD', to_currency='US
         return (prices / from_rate) * to_rate  # Convert from from_currency to to_currency
 
 
+@timed('fx.build_cross_rate_matrix')
+def build_cross_rate_matrix(rates, currencies=None) -> pd.DataFrame:
+    """Precomputes the conversion factor between every pair of currencies.
+
+    Every factor comes from `convert_to_base_currency`, so the USD and cross currency
+    special cases are only implemented there.
+
+    Args:
+        rates (dict): A dictionary containing exchange rates.
+        currencies (iterable): The currencies to include (default is every currency in `rates`).
+
+    Returns:
+        pd.DataFrame: Matrix where matrix.loc[from_currency, to_currency] converts an amount
+            in from_currency into to_currency.
+    """
+    currencies = list(dict.fromkeys(currencies if currencies is not None else rates))
+    factors = [
+        [convert_to_base_currency(1.0, rates, from_currency=from_currency, to_currency=to_currency) for to_currency in currencies]
+        for from_currency in currencies
+    ]
+    return pd.DataFrame(factors, index=pd.Index(currencies, name='from'), columns=pd.Index(currencies, name='to'), dtype=float)
+
+def convert_with_cross_rates(values, cross_rates: pd.DataFrame, from_currency='USD', to_currency='USD'):
+    """Converts a scalar, Series or DataFrame held in a single currency using a precomputed cross rate matrix."""
+    from_currency = from_currency or 'USD'  # Prices without a currency are treated as USD, like convert_to_base_currency
+    return values * cross_rates.loc[from_currency, to_currency]
+
+@timed('fx.convert_frame_to_base_currency')
+def convert_frame_to_base_currency(frame: pd.DataFrame, cross_rates: pd.DataFrame, to_currency='USD', columns=('value',), currency_column='currency') -> pd.DataFrame:
+    """Converts the given columns of a mixed currency frame in a single vectorized operation.
+
+    Args:
+        frame (pd.DataFrame): Frame holding the amounts and the currency of each row.
+        cross_rates (pd.DataFrame): Result of `build_cross_rate_matrix` covering every currency of the frame.
+        to_currency (str): The target currency to convert to (default is 'USD').
+        columns (iterable): The columns to convert.
+        currency_column (str): The column holding the currency of each row.
+
+    Returns:
+        pd.DataFrame: A copy of the frame with the given columns converted to the target currency.
+    """
+    factors = frame[currency_column].fillna('USD').map(cross_rates[to_currency])
+    converted = frame.copy()
+    converted[list(columns)] = frame[list(columns)].mul(factors, axis=0)
+    return converted
@@ -0,0 +1,174 @@
+"""
+Concurrent market data fetching with bounded concurrency, per-request timeouts and retries.
+
+The vendor libraries (yfinance, pandas_datareader, requests) are blocking, so each request runs on a
+worker thread driven by an asyncio event loop. The loop enforces the timeouts and backoff, and a request
+that times out is abandoned instead of blocking the page. `run_fetches` is the synchronous entry point.
+"""
+from __future__ import annotations
+
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from pydantic import BaseModel, Field
+
+from utils.lazy_import_helper import lazy_import
+from utils.perf_helper import count, propagate_context
+
+requests = lazy_import('requests')
+
+FETCH_CONCURRENCY = 8  # Requests running at the same time
+FETCH_TIMEOUT = 20  # Seconds before an attempt is abandoned
+FETCH_RETRIES = 2  # Attempts made after the first failure
+FETCH_BACKOFF = 0.5  # Seconds before the first retry, doubled (with jitter) for every following one
+NON_RETRYABLE_ERRORS = (ValueError, KeyError)  # Errors describing the request itself (e.g. unknown ticker)
+RETRYABLE_HTTP_STATUSES = {408, 429}  # Client errors worth retrying, server errors are always retried
+
+
+class FetchOutcome(BaseModel):
+    """Result of a single request: its value, or the error of its last attempt."""
+    key: Any = Field(description='Key the request was submitted under')
+    value: Any = Field(default=None, description='Value returned by the request, None if it failed')
+    error: Optional[str] = Field(default=None, description='Error of the last attempt, None if it succeeded')
+    attempts: int = Field(default=0, description='Number of attempts made')
+    elapsed: float = Field(default=0.0, description='Seconds from the first attempt to the outcome')
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class FetchReport(BaseModel):
+    """Outcomes of a batch of requests, in the order they were submitted."""
+    outcomes: dict[Any, FetchOutcome] = Field(default_factory=dict)
+
+    @property
+    def values(self) -> dict:
+        return {key: outcome.value for key, outcome in self.outcomes.items() if outcome.ok}
+
+    @property
+    def errors(self) -> dict:
+        return {key: outcome.error for key, outcome in self.outcomes.items() if not outcome.ok}
+
+    @property
+    def complete(self) -> bool:
+        return all(outcome.ok for outcome in self.outcomes.values())
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, NON_RETRYABLE_ERRORS):
+        return False
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status in RETRYABLE_HTTP_STATUSES
+    return True
+
+def get_backoff_delay(attempt: int, backoff: float = FETCH_BACKOFF) -> float:
+    """Exponential backoff with jitter, `attempt` being the number of failed attempts so far."""
+    return backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+async def fetch_with_retries(
+    key,
+    request: Callable[[], Any],
+    semaphore: asyncio.Semaphore,
+    executor: ThreadPoolExecutor,
+    timeout: Optional[float] = FETCH_TIMEOUT,
+    retries: int = FETCH_RETRIES,
+    backoff: float = FETCH_BACKOFF,
+) -> FetchOutcome:
+    """Runs a blocking request on the executor, retrying failures and timeouts with backoff. A timeout of None waits indefinitely."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    outcome = FetchOutcome(key=key)
+    while True:
+        outcome.attempts += 1
+        try:
+            async with semaphore:
+                # Waits without wait_for, whose TimeoutError could not be told apart from one raised by the request
+                future = loop.run_in_executor(executor, propagate_context(request))
+                done, _ = await asyncio.wait({future}, timeout=timeout)
+            if future in done:
+                outcome.value = future.result()
+                outcome.error = None
+                break
+            future.cancel()
+            count('fetch.timeout')
+            outcome.error = f"Timed out after {timeout:g}s"
+        except Exception as e:
+            count('fetch.error')
+            outcome.error = str(e) or type(e).__name__
+            if not is_retryable(e):
+                break
+
+        if outcome.attempts > retries:
+            break
+        count('fetch.retry')
+        await asyncio.sleep(get_backoff_delay(outcome.attempts, backoff))
+
+    outcome.elapsed = time.perf_counter() - start
+    return outcome
+
+async def fetch_all(
+    fetches: dict[Any, Callable[[], Any]],
+    concurrency: int = FETCH_CONCURRENCY,
+    timeout: Optional[float] = FETCH_TIMEOUT,
+    retries: int = FETCH_RETRIES,
+    backoff: float = FETCH_BACKOFF,
+    on_result: Optional[Callable[[FetchOutcome, int, int], None]] = None,
+) -> FetchReport:
+    """
+    Runs the requests concurrently, at most `concurrency` at a time.
+
+    Args:
+        fetches (dict): Zero argument callables keyed by any hashable key.
+        on_result (callable): Optional callback called as on_result(outcome, completed, total) as each request finishes.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    # Timed out attempts keep their thread until the blocking call returns, leave room for them
+    executor = ThreadPoolExecutor(max_workers=concurrency * (retries + 1), thread_name_prefix='fetch')
+    outcomes = {}
+    try:
+        tasks = [
+            asyncio.ensure_future(fetch_with_retries(key, request, semaphore, executor, timeout, retries, backoff))
+            for key, request in fetches.items()
+        ]
+        for completed, task in enumerate(asyncio.as_completed(tasks), start=1):
+            outcome = await task
+            outcomes[outcome.key] = outcome
+            if on_result is not None:
+                on_result(outcome, completed, len(tasks))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return FetchReport(outcomes={key: outcomes[key] for key in fetches if key in outcomes})
+
+def run_fetches(fetches: dict[Any, Callable[[], Any]], **kwargs) -> FetchReport:
+    """
+    Synchronous entry point of `fetch_all`, usable from Streamlit scripts and worker threads.
+
+    Callbacks run on the calling thread, unless it already runs an event loop.
+    """
+    if not fetches:
+        return FetchReport()
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(fetch_all(fetches, **kwargs))
+
+    # Already inside an event loop, run the batch on its own loop in a helper thread
+    result = {}
+    def run():
+        result['report'] = asyncio.run(fetch_all(fetches, **kwargs))
+    thread = threading.Thread(target=propagate_context(run), name='fetch-loop')
+    thread.start()
+    thread.join()
+    return result['report']
+
+def fetch_json(url: str, params: Optional[dict] = None, session: Optional[requests.Session] = None, timeout: float = FETCH_TIMEOUT):
+    """GETs a JSON document, raising on HTTP errors. Pass a session to reuse pooled connections."""
+    response = (session or requests).get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
@@ -0,0 +1,275 @@
+"""
+Bulk import of vesting schedules from HRIS exports (CSV or Excel), one row per vest.
+
+Files are read in chunks and each chunk is validated with vectorized pandas operations, so exports with
+tens of thousands of rows never become one pydantic object per row. Invalid rows are reported and skipped.
+"""
+from __future__ import annotations
+
+import os
+import functools
+import numpy as np
+from datetime import date, datetime
+from typing import Callable, Iterator, Optional
+from pydantic import BaseModel, ConfigDict, Field
+
+from utils.base_templates import Equity, Portfolio, VestingSchedule
+from utils.lazy_import_helper import lazy_import
+from utils.perf_helper import count, span, timed
+
+pd = lazy_import('pandas')
+
+IMPORT_CHUNK_ROWS = 5000  # Rows read and validated at once
+IMPORT_COLUMN_ALIASES = {
+    'ticker': ('ticker', 'symbol', 'ticker symbol', 'stock symbol'),
+    'vesting_date': ('vesting_date', 'vesting date', 'vest date', 'vest_date', 'release date', 'date'),
+    'shares_vested': ('shares_vested', 'shares vested', 'shares', 'quantity', 'units', 'vested shares'),
+}
+EXCEL_EXTENSIONS = ('.xlsx', '.xlsm')
+TIME_OF_DAY_PATTERN = r'(?:[T ]\d{1,2}:\d{2}\S*|Z)$'  # Time of day and UTC offset following a date, e.g. T00:00:00+02:00
+NUMERIC_DATE_PATTERN = r'^(\d{1,2})[/.-](\d{1,2})[/.-](\d{4}|\d{2})$'  # Day and month in either order, e.g. 01/02/2024
+
+
+class ImportRowError(BaseModel):
+    row: int = Field(description='Row number in the file, the header being row 1')
+    message: str = Field(description='Why the row was skipped')
+
+
+class ImportResult(BaseModel):
+    """Vesting schedules read from an export, grouped by ticker, and the rows that were skipped."""
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    rows_read: int = Field(default=0, description='Data rows read from the file')
+    rows_imported: int = Field(default=0, description='Rows added to the portfolio')
+    schedules: dict[str, VestingSchedule] = Field(default_factory=dict, description='Valid vests by ticker')
+    source_rows: dict[str, np.ndarray] = Field(default_factory=dict, description='File row number of every vest, by ticker')
+    errors: list[ImportRowError] = Field(default_factory=list, description='Skipped rows')
+
+    def errors_frame(self) -> pd.DataFrame:
+        return pd.DataFrame([error.model_dump() for error in self.errors], columns=['row', 'message'])
+
+
+def resolve_columns(columns) -> dict:
+    """Maps the file's column names to 'ticker', 'vesting_date' and 'shares_vested', raising if one is missing."""
+    normalized = {" ".join(str(column).lower().replace('_', ' ').split()): column for column in columns}
+    mapping, missing = {}, []
+    for field, aliases in IMPORT_COLUMN_ALIASES.items():
+        column = next((normalized[alias.replace('_', ' ')] for alias in aliases if alias.replace('_', ' ') in normalized), None)
+        if column is None:
+            missing.append(field)
+        else:
+            mapping[column] = field
+    if missing:
+        raise ValueError(f"Missing column(s) {', '.join(missing)}, found {', '.join(map(str, columns))}")
+    return mapping
+
+def iter_excel_chunks(file, chunk_rows: int = IMPORT_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Streams the first sheet of an Excel workbook in chunks of rows (requires openpyxl)."""
+    from openpyxl import load_workbook  # Optional dependency, only needed for Excel imports
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_rows:
+                yield pd.DataFrame(chunk, columns=header)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=header)
+    finally:
+        workbook.close()
+
+def iter_import_chunks(file, file_name: str, chunk_rows: int = IMPORT_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Streams a CSV or Excel export in chunks of rows, with the columns renamed to the expected fields."""
+    if os.path.splitext(file_name)[1].lower() in EXCEL_EXTENSIONS:
+        chunks = iter_excel_chunks(file, chunk_rows)
+    else:
+        chunks = pd.read_csv(file, chunksize=chunk_rows, dtype=str, skipinitialspace=True)
+
+    mapping = None
+    for chunk in chunks:
+        if mapping is None:
+            mapping = resolve_columns(chunk.columns)
+        yield chunk[list(mapping)].rename(columns=mapping)
+
+@functools.lru_cache(maxsize=4096)
+def get_local_midnight(day: date) -> int:
+    """Timestamp of local midnight of a date, matching the dates entered in the form (DST rules included)."""
+    return int(datetime.combine(day, datetime.min.time()).timestamp())
+
+def clean_date_values(values: pd.Series) -> pd.Series:
+    """Returns the dates as strings, without any time of day or UTC offset."""
+    return values.astype('string').str.strip().str.replace(TIME_OF_DAY_PATTERN, '', regex=True)
+
+def get_numeric_date_parts(values: pd.Series) -> pd.DataFrame:
+    """Splits DD/MM/YYYY or MM/DD/YYYY dates into their 'first', 'second' and 'year' numbers, NaN for other values."""
+    parts = clean_date_values(values).str.extract(NUMERIC_DATE_PATTERN).astype('Float64').astype('float64')
+    parts.columns = ['first', 'second', 'year']
+    parts['year'] = parts['year'].where(parts['year'] >= 100, parts['year'] + 2000)
+    return parts
+
+def infer_dayfirst(values: pd.Series) -> Optional[bool]:
+    """
+    Infers whether numeric dates put the day first from the first one that can only be read one way
+    (e.g. 13/01/2024), None if every date reads both ways.
+    """
+    parts = get_numeric_date_parts(values)
+    decisive = ((parts['first'] > 12) | (parts['second'] > 12)).to_numpy()
+    if not decisive.any():
+        return None
+    return bool(parts['first'].iloc[decisive.argmax()] > 12)
+
+def parse_vesting_dates(values: pd.Series, dayfirst: Optional[bool] = None) -> tuple[pd.Series, pd.Series]:
+    """
+    Parses vesting dates as the calendar date written in the export. Any time of day or UTC offset is dropped,
+    so rows with different offsets never mix timezones. Numeric dates are read in the given day / month order,
+    without one (dayfirst=None) only those that read a single way are parsed.
+
+    Returns:
+        tuple[pd.Series, pd.Series]: The dates, NaT where a value is not a date or is ambiguous, and the
+            mask of the ambiguous values (e.g. 01/02/2024 without a day / month order).
+    """
+    values = clean_date_values(values)
+    parts = get_numeric_date_parts(values)
+    numeric = parts['first'].notna()
+
+    # ISO and written out dates read one way only. What is left is naive, utc=True only guarantees a datetime column
+    dates = pd.to_datetime(values.where(~numeric), errors='coerce', format='mixed', utc=True).dt.tz_localize(None).dt.normalize()
+
+    first, second = parts['first'], parts['second']
+    if dayfirst is None:
+        ambiguous = numeric & (first <= 12) & (second <= 12) & (first != second)
+        row_dayfirst = first > 12
+    else:
+        ambiguous = pd.Series(False, index=values.index)
+        row_dayfirst = pd.Series(dayfirst, index=values.index)
+    readable = numeric & ~ambiguous
+    if readable.any():
+        numeric_dates = pd.to_datetime(pd.DataFrame({
+            'year': parts['year'][readable],
+            'month': second.where(row_dayfirst, first)[readable],
+            'day': first.where(row_dayfirst, second)[readable],
+        }), errors='coerce')
+        dates = dates.where(~readable, numeric_dates.reindex(dates.index))
+    return dates, ambiguous
+
+def validate_chunk(chunk: pd.DataFrame, first_row: int, dayfirst: Optional[bool] = None) -> tuple[pd.DataFrame, list[ImportRowError]]:
+    """
+    Validates a chunk of rows in bulk. Numeric dates are read in the given day / month order (see `parse_vesting_dates`).
+
+    Returns:
+        The valid rows with the columns 'row', 'ticker', 'vesting_date' (local midnight timestamp) and
+        'shares_vested', and an error for every other row.
+    """
+    rows = np.arange(first_row, first_row + len(chunk))
+    tickers = chunk['ticker'].astype('string').str.strip().str.upper()
+    dates, ambiguous_dates = parse_vesting_dates(chunk['vesting_date'], dayfirst)
+    shares = pd.to_numeric(chunk['shares_vested'], errors='coerce')
+
+    problems = [
+        (tickers.isna() | (tickers == ''), "Missing ticker"),
+        (ambiguous_dates, "Ambiguous vesting date, choose whether the day or the month comes first"),
+        (dates.isna(), "Invalid vesting date"),
+        (~np.isfinite(shares), "Invalid number of shares"),  # Also rejects inf
+        (shares < 0, "Negative number of shares"),
+    ]
+    invalid = np.zeros(len(chunk), dtype=bool)
+    errors = []
+    for mask, message in problems:
+        mask = mask.fillna(False).to_numpy(dtype=bool) & ~invalid  # One error per row, the first problem found
+        errors.extend(ImportRowError(row=row, message=message) for row in rows[mask].tolist())
+        invalid |= mask
+
+    valid = ~invalid
+    # Vesting dates are stored as the timestamp of local midnight, like the dates entered in the form. Exports
+    # repeat the same few vesting dates, so each distinct date is converted once and mapped back to its rows
+    days, day_index = np.unique(dates[valid].to_numpy(dtype='datetime64[D]'), return_inverse=True)
+    vesting_dates = np.array([get_local_midnight(day) for day in days.astype(object)], dtype=np.int64)[day_index]
+    return pd.DataFrame({
+        'row': rows[valid],
+        'ticker': tickers[valid].to_numpy(dtype=object),
+        'vesting_date': vesting_dates,
+        'shares_vested': shares[valid].to_numpy(dtype=np.float64),
+    }), errors
+
+@timed('import.read_vesting_schedules')
+def read_vesting_schedules(file, file_name: str, chunk_rows: int = IMPORT_CHUNK_ROWS, dayfirst: Optional[bool] = None) -> ImportResult:
+    """
+    Reads and validates an export chunk by chunk, grouping the valid vests by ticker.
+
+    Numeric dates are read in one day / month order for the whole file: `dayfirst` if given, otherwise
+    the order of the first date that reads a single way. Ambiguous dates before it are reported as errors.
+    """
+    result = ImportResult()
+    valid_chunks = []
+    first_row = 2  # Row 1 is the header
+    for chunk in iter_import_chunks(file, file_name, chunk_rows):
+        if dayfirst is None:
+            dayfirst = infer_dayfirst(chunk['vesting_date'])
+        valid, errors = validate_chunk(chunk, first_row, dayfirst)
+        valid_chunks.append(valid)
+        result.errors.extend(errors)
+        result.rows_read += len(chunk)
+        first_row += len(chunk)
+    count('import.rows', result.rows_read)
+
+    if valid_chunks:
+        valid = pd.concat(valid_chunks, ignore_index=True)
+        for ticker, rows in valid.groupby('ticker', sort=False):
+            result.schedules[ticker] = VestingSchedule(rows['vesting_date'].to_numpy(), rows['shares_vested'].to_numpy())
+            result.source_rows[ticker] = rows['row'].to_numpy()
+    return result
+
+def apply_import(portfolio: Portfolio, result: ImportResult, equities: dict[str, Equity], ticker_errors: Optional[dict[str, str]] = None) -> None:
+    """
+    Adds the imported vests to the portfolio: appended to the equity holding the ticker if there is one,
+    otherwise to the resolved equity, which is added. Rows of tickers that could not be resolved, or whose
+    equity name is already held under another ticker, become errors.
+    """
+    equities_by_ticker = {equity.ticker: equity for equity in portfolio.equities.values()}
+    for ticker, schedule in result.schedules.items():
+        equity = equities_by_ticker.get(ticker)
+        message = None
+        if equity is None and ticker in equities:
+            equity = equities[ticker]
+            held = portfolio.equities.get(equity.name)
+            if held is None:
+                portfolio.equities[equity.name] = equities_by_ticker[ticker] = equity
+            else:  # Equities are keyed by name, never merge the vests of two tickers
+                message = f"Ticker {ticker} conflicts with the equity {equity.name} already in the portfolio ({held.ticker or 'no ticker'})"
+        elif equity is None:
+            message = f"Unknown ticker {ticker}: {(ticker_errors or {}).get(ticker, 'not found')}"
+        if message is not None:
+            result.errors.extend(ImportRowError(row=row, message=message) for row in result.source_rows[ticker].tolist())
+            continue
+
+        equity.vesting_events.append(schedule.vesting_dates, schedule.shares_vested)
+        equity.vesting_events.sort()
+        result.rows_imported += len(schedule)
+    result.errors.sort(key=lambda error: error.row)
+
+@timed('import.import_vesting_schedules')
+def import_vesting_schedules(portfolio: Portfolio, file, file_name: str, resolve_tickers: Optional[Callable] = None, chunk_rows: int = IMPORT_CHUNK_ROWS, dayfirst: Optional[bool] = None) -> ImportResult:
+    """
+    Imports an HRIS export into the portfolio. Each unique ticker not already in the portfolio is resolved once,
+    with `resolve_tickers(tickers) -> (equities, errors)` (`get_equities_from_tickers` by default).
+    `dayfirst` sets the day / month order of numeric dates, inferred from the file if None.
+    """
+    result = read_vesting_schedules(file, file_name, chunk_rows, dayfirst)
+
+    held_tickers = {equity.ticker for equity in portfolio.equities.values()}
+    new_tickers = [ticker for ticker in result.schedules if ticker not in held_tickers]
+    equities, ticker_errors = {}, {}
+    if new_tickers:
+        if resolve_tickers is None:
+            from utils.yahoo_search_helper import get_equities_from_tickers as resolve_tickers
+        with span('import.resolve_tickers'):
+            equities, ticker_errors = resolve_tickers(new_tickers)
+
+    apply_import(portfolio, result, equities, ticker_errors)
+    return result
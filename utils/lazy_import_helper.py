@@ -0,0 +1,50 @@
+"""
+Deferred imports of heavy third-party modules.
+
+`pd = lazy_import('pandas')` binds a placeholder module that imports pandas on first attribute access,
+so importing a helper module does not pay for libraries only some of its functions use. Annotations
+referring to lazy modules must not be evaluated at import time (use `from __future__ import annotations`).
+"""
+import sys
+import types
+import importlib
+
+from utils.perf_helper import span
+
+
+class LazyModule(types.ModuleType):
+    """Placeholder for a module, imported the first time one of its attributes is accessed."""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__['_module']
+        if module is None:
+            with span(f'import.{self.__name__}'):  # Shows in the trace of the rerun paying for the import
+                module = importlib.import_module(self.__name__)  # Thread-safe, the import system has its own locks
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(self._load(), name, value)  # e.g. mock.patch.object on the placeholder patches the real module
+
+    def __delattr__(self, name: str) -> None:
+        delattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Returns the module if it is already imported, otherwise a placeholder importing it on first use."""
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
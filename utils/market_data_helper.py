@@ -0,0 +1,374 @@
+"""
+Market data providers: the single place the app talks to Yahoo Finance and FRED.
+
+`get_provider()` returns the process wide provider, shared by every Streamlit session. By default it calls
+the vendors through a `GuardedProvider`, which coalesces identical in-flight requests into one upstream call
+and rate limits each upstream with a token bucket. Set EQUITY_TRANSFERS_MARKET_DATA_RECORD to a directory to
+record every response as a fixture file, and EQUITY_TRANSFERS_MARKET_DATA_REPLAY to replay such a directory
+fully offline.
+"""
+from __future__ import annotations
+
+import os
+import json
+import time
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import date
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+
+from utils.base_templates import PriceHistory
+from utils.fetch_helper import FETCH_TIMEOUT, fetch_json
+from utils.lazy_import_helper import lazy_import
+from utils.perf_helper import count, span
+
+pd = lazy_import('pandas')
+requests = lazy_import('requests')
+yf = lazy_import('yfinance')
+web = lazy_import('pandas_datareader.data')
+
+MARKET_DATA_RECORD_ENV = 'EQUITY_TRANSFERS_MARKET_DATA_RECORD'  # Directory every upstream response is recorded to
+MARKET_DATA_REPLAY_ENV = 'EQUITY_TRANSFERS_MARKET_DATA_REPLAY'  # Directory of recorded responses to replay instead
+
+SEARCH_URL = 'https://query1.finance.yahoo.com/v1/finance/search'
+SEARCH_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.109 Safari/537.36',
+}
+SEARCH_QUOTES_COUNT = 10
+SEARCH_TIMEOUT = 5  # Seconds before a search request is abandoned
+SEARCH_POOL_SIZE = 16  # Maximum number of pooled connections to the search endpoint
+
+# Upstream of every provider request, and the rate limit of each upstream as (requests per second, burst)
+REQUEST_UPSTREAMS = {'get_history': 'yahoo', 'get_ticker_info': 'yahoo', 'search_quotes': 'yahoo_search', 'get_fred_series': 'fred'}
+RATE_LIMITS = {'yahoo': (5.0, 10), 'yahoo_search': (10.0, 20), 'fred': (2.0, 5)}
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens are added per second, up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: float) -> float:
+        """Takes the tokens (possibly going into debt) and returns how long to wait until they are covered."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, tokens: float = 1) -> float:
+        """Blocks until the tokens are available, in request order, and returns the seconds waited."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            count('provider.throttled')
+            time.sleep(wait)
+        return wait
+
+
+class RequestCoalescer:
+    """Runs identical requests issued while one is in flight only once, sharing its result (or error)."""
+
+    def __init__(self):
+        self._in_flight = {}  # Request key -> Future of the call running for it
+        self._lock = threading.Lock()
+
+    def run(self, key: Hashable, call: Callable[[], Any]) -> Any:
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            is_owner = in_flight is None
+            if is_owner:
+                in_flight = self._in_flight[key] = Future()
+
+        if not is_owner:
+            count('provider.coalesced')
+            return in_flight.result()
+
+        try:
+            result = call()
+            in_flight.set_result(result)
+            return result
+        except BaseException as e:  # Also KeyboardInterrupt and the like, waiters would block forever otherwise
+            in_flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+
+class MarketDataProvider(ABC):
+    """Interface of the market data sources. Every method is a single upstream request."""
+
+    @abstractmethod
+    def get_history(self, ticker: str, start: Optional[date] = None) -> PriceHistory:
+        """Daily closing prices from `start` onwards, or of the last year without a start (empty if none)."""
+
+    @abstractmethod
+    def get_ticker_info(self, ticker: str) -> dict:
+        """The 'name', 'currency' and 'isin' of a ticker."""
+
+    @abstractmethod
+    def search_quotes(self, query: str) -> list:
+        """The quotes (dictionaries with 'symbol', 'shortname', ...) matching a search query."""
+
+    @abstractmethod
+    def get_fred_series(self, series_id: str, start: date) -> pd.Series:
+        """The observations of a FRED series from `start` onwards, indexed by date."""
+
+
+class VendorProvider(MarketDataProvider):
+    """Calls yfinance, the Yahoo Finance search endpoint and FRED."""
+
+    def __init__(self):
+        self._search_session = None
+        self._lock = threading.Lock()
+
+    def get_search_session(self) -> requests.Session:
+        """Returns the connection pooled session used for ticker searches."""
+        if self._search_session is None:
+            from requests.adapters import HTTPAdapter
+            with self._lock:
+                if self._search_session is None:
+                    session = requests.Session()
+                    session.headers.update(SEARCH_HEADERS)
+                    session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=SEARCH_POOL_SIZE))
+                    self._search_session = session
+        return self._search_session
+
+    def get_history(self, ticker: str, start: Optional[date] = None) -> PriceHistory:
+        count('network.yahoo.history')
+        if start is None:
+            history = yf.Ticker(ticker).history(period="1y", timeout=FETCH_TIMEOUT)  # 'Close' prices for 1 year
+        else:
+            history = yf.Ticker(ticker).history(start=start, timeout=FETCH_TIMEOUT)
+        if history.empty:
+            return PriceHistory([], [])
+        return PriceHistory.from_series(history['Close'])
+
+    def get_ticker_info(self, ticker: str) -> dict:
+        count('network.yahoo.info')
+        yf_ticker = yf.Ticker(ticker)
+        info = yf_ticker.info
+        return {
+            'name': info.get("shortName") or info.get("longName", None),
+            'currency': info.get('currency', None),
+            'isin': yf_ticker.isin,
+        }
+
+    def search_quotes(self, query: str) -> list:
+        count('network.yahoo.search')
+        params = dict(
+            q=query,
+            quotesCount=SEARCH_QUOTES_COUNT,
+            newsCount=0,
+            listsCount=0,
+            quotesQueryId='tss_match_phrase_query'
+        )
+        data = fetch_json(SEARCH_URL, params=params, session=self.get_search_session(), timeout=SEARCH_TIMEOUT)
+        return data.get("quotes", [])  # No "quotes" when nothing was found
+
+    def get_fred_series(self, series_id: str, start: date) -> pd.Series:
+        count('network.fred')
+        return web.get_data_fred(series_id, start=start, timeout=FETCH_TIMEOUT)[series_id].dropna()
+
+
+class GuardedProvider(MarketDataProvider):
+    """
+    Wraps a provider so identical in-flight requests share one upstream call and every upstream is rate limited.
+    The token is taken by the coalesced call only, so followers never count against the limit.
+    """
+
+    def __init__(self, provider: MarketDataProvider, rate_limits: Optional[dict] = None):
+        self.provider = provider
+        rate_limits = RATE_LIMITS if rate_limits is None else rate_limits
+        self.buckets = {upstream: TokenBucket(rate, capacity) for upstream, (rate, capacity) in rate_limits.items()}
+        self.coalescer = RequestCoalescer()
+
+    def _request(self, method: str, *args) -> Any:
+        def call():
+            bucket = self.buckets.get(REQUEST_UPSTREAMS[method])
+            if bucket is not None:
+                with span('provider.rate_limit'):
+                    bucket.acquire()
+            return getattr(self.provider, method)(*args)
+        return self.coalescer.run((method, *args), call)
+
+    def get_history(self, ticker: str, start: Optional[date] = None) -> PriceHistory:
+        return self._request('get_history', ticker, start)
+
+    def get_ticker_info(self, ticker: str) -> dict:
+        return self._request('get_ticker_info', ticker)
+
+    def search_quotes(self, query: str) -> list:
+        return self._request('search_quotes', query)
+
+    def get_fred_series(self, series_id: str, start: date) -> pd.Series:
+        return self._request('get_fred_series', series_id, start)
+
+
+def get_fixture_path(fixture_dir: str, method: str, key: str) -> str:
+    """Fixtures are stored per request and identifier (ticker, query or series), e.g. get_history/AAPL-1a2b3c4d.json."""
+    readable = "".join(character if character.isalnum() else '_' for character in key)[:40]
+    return os.path.join(fixture_dir, method, f"{readable}-{hashlib.sha1(key.encode()).hexdigest()[:8]}.json")
+
+def price_history_to_fixture(price_history: PriceHistory) -> dict:
+    return {'timestamps': price_history.timestamps.tolist(), 'prices': price_history.prices.tolist()}
+
+def price_history_from_fixture(data: dict) -> PriceHistory:
+    return PriceHistory(data['timestamps'], data['prices'])
+
+def fred_series_to_fixture(series: pd.Series) -> dict:
+    return {'dates': series.index.strftime('%Y-%m-%d').tolist(), 'values': series.tolist()}
+
+def fred_series_from_fixture(data: dict, series_id: str) -> pd.Series:
+    return pd.Series(data['values'], index=pd.DatetimeIndex(pd.to_datetime(data['dates']), name='DATE'), name=series_id, dtype=float)
+
+
+class RecordingProvider(MarketDataProvider):
+    """
+    Forwards every request to a provider and records the response as a fixture file for `ReplayProvider`.
+    Histories and FRED series recorded several times are merged, so one directory covers every start date.
+    """
+
+    def __init__(self, provider: MarketDataProvider, fixture_dir: str):
+        self.provider = provider
+        self.fixture_dir = fixture_dir
+        self._lock = threading.Lock()
+
+    def _record(self, method: str, key: str, response: Any, merge: Optional[Callable[[Any, Any], Any]] = None) -> None:
+        path = get_fixture_path(self.fixture_dir, method, key)
+        with self._lock:
+            if merge is not None and os.path.exists(path):
+                with open(path) as f:
+                    response = merge(json.load(f)['response'], response)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump({'request': method, 'key': key, 'response': response}, f)
+            os.replace(temp_path, path)
+
+    def get_history(self, ticker: str, start: Optional[date] = None) -> PriceHistory:
+        price_history = self.provider.get_history(ticker, start)
+        def merge(recorded, new):
+            timestamps, first = np.unique(np.concatenate((new['timestamps'], recorded['timestamps'])).astype(np.int64), return_index=True)
+            prices = np.concatenate((new['prices'], recorded['prices']))[first]
+            return {'timestamps': timestamps.tolist(), 'prices': prices.tolist()}
+        self._record('get_history', ticker, price_history_to_fixture(price_history), merge)
+        return price_history
+
+    def get_ticker_info(self, ticker: str) -> dict:
+        info = self.provider.get_ticker_info(ticker)
+        self._record('get_ticker_info', ticker, info)
+        return info
+
+    def search_quotes(self, query: str) -> list:
+        quotes = self.provider.search_quotes(query)
+        self._record('search_quotes', query, quotes)
+        return quotes
+
+    def get_fred_series(self, series_id: str, start: date) -> pd.Series:
+        series = self.provider.get_fred_series(series_id, start)
+        def merge(recorded, new):
+            merged = dict(zip(recorded['dates'], recorded['values']))
+            merged.update(zip(new['dates'], new['values']))
+            dates = sorted(merged)
+            return {'dates': dates, 'values': [merged[day] for day in dates]}
+        self._record('get_fred_series', series_id, fred_series_to_fixture(series), merge)
+        return series
+
+
+class ReplayProvider(MarketDataProvider):
+    """
+    Answers requests from fixture files recorded by `RecordingProvider`, without any network access.
+    Recorded histories and series are cut at the requested start date. Unrecorded requests raise a KeyError.
+    """
+
+    def __init__(self, fixture_dir: str):
+        self.fixture_dir = fixture_dir
+
+    def _load(self, method: str, key: str) -> Any:
+        path = get_fixture_path(self.fixture_dir, method, key)
+        if not os.path.exists(path):
+            raise KeyError(f"No recorded {method} response for {key} in {self.fixture_dir}")
+        count('provider.replay')
+        with open(path) as f:
+            return json.load(f)['response']
+
+    def recorded_keys(self, method: str) -> list[str]:
+        """The identifiers (tickers, queries or series) recorded for a request."""
+        method_dir = os.path.join(self.fixture_dir, method)
+        if not os.path.isdir(method_dir):
+            return []
+        keys = []
+        for file_name in sorted(os.listdir(method_dir)):
+            if file_name.endswith('.json'):
+                with open(os.path.join(method_dir, file_name)) as f:
+                    keys.append(json.load(f)['key'])
+        return keys
+
+    def get_history(self, ticker: str, start: Optional[date] = None) -> PriceHistory:
+        price_history = price_history_from_fixture(self._load('get_history', ticker))
+        if start is None:
+            return price_history
+        keep = price_history.timestamps >= int(pd.Timestamp(start).timestamp())
+        return PriceHistory(price_history.timestamps[keep], price_history.prices[keep])
+
+    def get_ticker_info(self, ticker: str) -> dict:
+        return self._load('get_ticker_info', ticker)
+
+    def search_quotes(self, query: str) -> list:
+        return self._load('search_quotes', query)
+
+    def get_fred_series(self, series_id: str, start: date) -> pd.Series:
+        series = fred_series_from_fixture(self._load('get_fred_series', series_id), series_id)
+        return series[series.index >= pd.Timestamp(start)]
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+def create_default_provider() -> MarketDataProvider:
+    """Replays fixtures if EQUITY_TRANSFERS_MARKET_DATA_REPLAY is set, otherwise calls the (optionally recorded) vendors."""
+    replay_dir = os.environ.get(MARKET_DATA_REPLAY_ENV)
+    if replay_dir:
+        return GuardedProvider(ReplayProvider(replay_dir), rate_limits={})  # Nothing upstream to protect
+    provider = VendorProvider()
+    record_dir = os.environ.get(MARKET_DATA_RECORD_ENV)
+    if record_dir:
+        provider = RecordingProvider(provider, record_dir)
+    return GuardedProvider(provider)
+
+def get_provider() -> MarketDataProvider:
+    """Returns the process wide provider, shared by every session so their requests are coalesced and rate limited together."""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = create_default_provider()
+    return _provider
+
+def set_provider(provider: Optional[MarketDataProvider]) -> Optional[MarketDataProvider]:
+    """Replaces the process wide provider (None restores the default) and returns the previous one."""
+    global _provider
+    with _provider_lock:
+        previous, _provider = _provider, provider
+    return previous
+
+@contextmanager
+def use_provider(provider: MarketDataProvider):
+    """Uses the given provider for the duration of the block, e.g. a `ReplayProvider` in benchmarks."""
+    previous = set_provider(provider)
+    try:
+        yield provider
+    finally:
+        set_provider(previous)
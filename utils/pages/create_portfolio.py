@@ -1,8 +1,17 @@
+from __future__ import annotations
+
 import streamlit as st
 from datetime import datetime
-from utils.yahoo_search_helper import search_functionality
+from utils.yahoo_search_helper import search_functionality, bulk_search_functionality, get_equities_from_tickers
 from utils.session_state_helper import remove_equity, add_portfolio
-from utils.base_templates import VestingEvent
+from utils.base_templates import VestingSchedule
+from utils.import_helper import import_vesting_schedules
+from utils.lazy_import_helper import lazy_import
+
+pd = lazy_import('pandas')
+
+MAX_DISPLAYED_IMPORT_ERRORS = 1000
+IMPORT_DATE_ORDERS = {"Detect from the file": None, "Day first (DD/MM/YYYY)": True, "Month first (MM/DD/YYYY)": False}
 
 def display_add_portfolio_page(new_portfolio_name: str):
     st.write(f"Add Equities to {new_portfolio_name}")
@@ -10,61 +19,76 @@ def display_add_portfolio_page(new_portfolio_name: str):
 
     # Search functionality for equities
     search_functionality("main_search")
+    with st.expander("Bulk add tickers"):
+        bulk_search_functionality("main_search")
+    with st.expander("Import vesting schedules (CSV / Excel export)"):
+        display_import_section()
 
     if st.session_state['current_portfolio'].equities:
         st.write("Current Equities in Portfolio:")
 
         # Loop through each equity in the portfolio
         for name, equity in st.session_state['current_portfolio'].equities.copy().items():
-            col1, col2 = st.columns([3, 1])
-            with col1:
-                st.write(f"- **{equity.name}** ({equity.ticker})")
-
+            st.write(f"- **{equity.name}** ({equity.ticker}), {len(equity.vesting_events)} vesting events")
 
-            with col2:
-                # Button to add a new vesting event (outside of form)
-                if st.button(f"Add Vesting Event for {equity.name}"):
-                    st.session_state['current_portfolio'].equities[equity.name].vesting_events.append(
-                        {}
-                    )
-
-            # Form to manage vesting events for the equity
+            # The whole schedule is edited in a single table, rows can be added and deleted
             with st.expander(f"Vesting Events for {equity.name}"):
                 with st.form(f"equities_form_{equity.name}"):
-                    for i, event in enumerate(st.session_state['current_portfolio'].equities[equity.name].vesting_events):
-                        col1, col2, col3, col4 = st.columns([2, 3, 3, 2])
-                        
-                        with col1:
-                            st.write(f"Vesting Event {i + 1}")
-
-                        with col2:
-                            # Input for shares vested
-                            event['shares_vested'] = st.number_input(
-                                "Shares Vested",
-                                min_value=0,
-                                key=f"shares_vested_{equity.name}_{i}"
-                            )
-
-                        with col3:
-                            # Input for vesting date
-                            vesting_date = st.date_input(
-                                "Vesting Date",
-                                key=f"vesting_date_{equity.name}_{i}"
-                            )
-                            # Convert to datetime.datetime and store timestamp
-                            event['vesting_date'] = int(datetime.combine(vesting_date, datetime.min.time()).timestamp())
-                            event = VestingEvent(**event)
-                        with col4:
-                            # Checkbox to delete the vesting event
-                            if st.checkbox("Delete", key=f"delete_event_{equity.name}_{i}"):
-                                st.session_state['current_portfolio'].equities[equity.name].vesting_events.pop(i)
+                    editor_key = f"vesting_editor_{equity.name}"
+                    edited_schedule = st.data_editor(
+                        schedule_to_frame(equity.vesting_events),
+                        key=editor_key,
+                        num_rows="dynamic",
+                        hide_index=True,
+                        column_config={
+                            "Vesting Date": st.column_config.DateColumn("Vesting Date", required=True),
+                            "Shares Vested": st.column_config.NumberColumn("Shares Vested", min_value=0.0, required=True),
+                        },
+                    )
 
                     # Submit button inside the form to save changes for the current equity
                     save_button = st.form_submit_button(f"Save {equity.name}")
 
                     # If the form is submitted
                     if save_button:
+                        equity.vesting_events = frame_to_schedule(edited_schedule)
+                        # The editor stores its edits relative to the schedule it was given, reset it for the new one
+                        st.session_state.pop(editor_key, None)
+
                         # Save changes to the portfolio after each equity update
                         add_portfolio()
                         st.success(f"Changes to {equity.name} saved successfully!")
 
+def schedule_to_frame(schedule: VestingSchedule) -> pd.DataFrame:
+    return pd.DataFrame({
+        "Vesting Date": pd.to_datetime([datetime.fromtimestamp(vesting_date) for vesting_date in schedule.vesting_dates.tolist()]).date,
+        "Shares Vested": schedule.shares_vested,
+    })
+
+def frame_to_schedule(frame: pd.DataFrame) -> VestingSchedule:
+    """Converts the edited table back to a date sorted schedule, skipping incomplete rows."""
+    frame = frame.dropna(subset=["Vesting Date", "Shares Vested"])
+    # Store the timestamp of local midnight of each date, like the date inputs did
+    vesting_dates = [int(datetime.combine(vesting_date, datetime.min.time()).timestamp()) for vesting_date in frame["Vesting Date"]]
+    schedule = VestingSchedule(vesting_dates, frame["Shares Vested"].to_numpy(dtype=float))
+    schedule.sort()
+    return schedule
+
+def display_import_section():
+    st.write("One row per vest with the columns ticker, vesting date and shares vested.")
+    uploaded_file = st.file_uploader("HRIS export", type=["csv", "xlsx", "xlsm"], key="vesting_import_file")
+    date_order = st.selectbox("Date order of numeric dates", options=list(IMPORT_DATE_ORDERS), key="vesting_import_date_order")
+    if uploaded_file is not None and st.button("Import Vesting Events"):
+        with st.spinner(f"Importing {uploaded_file.name}..."):
+            try:
+                result = import_vesting_schedules(st.session_state['current_portfolio'], uploaded_file, uploaded_file.name, resolve_tickers=get_equities_from_tickers, dayfirst=IMPORT_DATE_ORDERS[date_order])
+            except (ValueError, ImportError) as e:
+                st.error(f"Could not read {uploaded_file.name}: {e}")
+                return
+
+        if result.rows_imported:
+            add_portfolio()
+        st.success(f"Imported {result.rows_imported:,} of {result.rows_read:,} rows for {len(result.schedules)} tickers.")
+        if result.errors:
+            st.warning(f"{len(result.errors):,} rows were skipped.")
+            st.dataframe(result.errors_frame().head(MAX_DISPLAYED_IMPORT_ERRORS), hide_index=True)
@@ -1,20 +1,24 @@
 import streamlit as st
-import pandas as pd
-from datetime import datetime
-from utils.session_state_helper import load_portfolios_from_json
-from utils.exchange_rates_helper import fetch_latest_exchange_rates, convert_to_base_currency
+from utils.portfolio_store_helper import load_portfolio, load_portfolio_catalog
+from utils.exchange_rates_helper import fetch_latest_exchange_rates
+from utils.chart_helper import CHART_BAR_BUDGET, CHART_POINT_BUDGET, bucket_sums
+from utils.perf_helper import span
 
 def display_report_page():
-    # Load portfolios
-    portfolios = load_portfolios_from_json()
+    # Load the portfolio catalog, only the selected portfolio is decoded
+    catalog = {entry['name']: entry for entry in load_portfolio_catalog()}
 
     # Create a dropdown to select a portfolio
-    portfolio_names = list(portfolios.keys())
-    selected_portfolio_name = st.selectbox("Select a Portfolio", options=portfolio_names)
+    portfolio_names = list(catalog.keys())
+    selected_portfolio_name = st.selectbox(
+        "Select a Portfolio",
+        options=portfolio_names,
+        format_func=lambda name: f"{name} ({catalog[name]['equity_count']} equities, {catalog[name]['event_count']} vesting events)"
+    )
 
     if selected_portfolio_name:
         # Retrieve the selected portfolio
-        selected_portfolio = portfolios[selected_portfolio_name]
+        selected_portfolio = load_portfolio(selected_portfolio_name)
 
         # Display portfolio details
         st.write(f"**Selected Portfolio**: {selected_portfolio.name}")
@@ -33,90 +37,51 @@ def generate_report(selected_portfolio):
     selected_method = mapping[selected_method]
     base_currency = st.selectbox("Select Base Currency", options=["USD", "EUR", "GBP", "JPY", "AUD", "CAD", "CHF", "CNY", "NZD", "SGD", "HKD", "INR", "MXN", "ZAR"], index=0)
 
+    simulate = st.checkbox("Simulate the distribution of the value of unvested shares (Monte Carlo)")
+    if simulate:
+        from utils.simulation_helper import SIMULATION_PATHS, simulate_portfolio
+        n_paths = st.select_slider("Number of simulated price paths", options=[10_000, 50_000, SIMULATION_PATHS, 250_000, 1_000_000], value=SIMULATION_PATHS)
+
     if st.button("Generate Report"):
+        # The valuation modules need pandas, only import them once a report is requested
+        from utils.report_helper import get_cached_price_chart_data, get_cached_report, get_portfolio_cross_rates
+
         st.success(f"Generating report for portfolio: {selected_portfolio.name}")
         st.subheader("Recent price changes in underlying equities")
         # Collect the currencies for all equities in the selected portfolio
         currencies = {equity.currency for equity in selected_portfolio.equities.values()}
         
-        # Fetch the latest exchange rates for the currencies
-        rates = fetch_latest_exchange_rates(currencies)
-
-        # Initialize a DataFrame to hold the historical prices for the chart
-        price_data = pd.DataFrame()
-
-        # Collect historical price data for each equity in the portfolio
-        for equity in selected_portfolio.equities.values():
-            if equity.historical_prices:  # Ensure historical prices are available
-                # Convert the historical prices dictionary to a DataFrame
-                prices_df = pd.Series(equity.historical_prices).rename_axis('Date').reset_index(name='Price')
-                
-                # Convert timestamps back to datetime
-                prices_df['Date'] = pd.to_datetime(prices_df['Date'], unit='s')  # Convert timestamps to datetime
+        # Fetch the latest exchange rates for the currencies, and the base currency they are converted to
+        rates = fetch_latest_exchange_rates({*currencies, base_currency})
+        cross_rates = get_portfolio_cross_rates(selected_portfolio, rates, base_currency)
 
-                # Convert prices from USD to the selected base currency
-                prices_df['Price_in_base_currency'] = prices_df['Price'].apply(
-                    lambda price: convert_to_base_currency(price, rates, from_currency=equity.currency, to_currency=base_currency)
-                )
-
-                prices_df['Ticker'] = equity.ticker
-                
-                # Append to price data
-                price_data = pd.concat([price_data, prices_df[['Date', 'Price_in_base_currency', 'Ticker']]], ignore_index=True)
-
-        # Plotting the price data if available
-        if not price_data.empty:
-            # Pivoting the DataFrame to have dates as index and tickers as columns
-            price_data_pivoted = price_data.pivot(index='Date', columns='Ticker', values='Price_in_base_currency')
-            st.line_chart(price_data_pivoted)
+        # Plotting the price data if available, downsampled to CHART_POINT_BUDGET points per ticker
+        price_chart_points = get_cached_price_chart_data(selected_portfolio, base_currency, rates, cross_rates=cross_rates, max_points=CHART_POINT_BUDGET)
+        if not price_chart_points.empty:
+            with span('render.price_chart'):
+                st.line_chart(price_chart_points, x='Date', y=f'Price ({base_currency})', color='Ticker')
 
         # Display payout schedule
         st.subheader("Payout Schedule")
-        payout_schedule = []
-        current_time = datetime.now().timestamp()
-
-        # Initialize a total portfolio value
-        total_portfolio_value = 0
-
-        # Collect payout events for each equity
-        for equity in selected_portfolio.equities.values():
-            for event in equity.vesting_events:
-                # Calculate the value of each vesting event based on the selected method
-                value = equity.calculate_value(method=selected_method)
-                value = convert_to_base_currency(value, rates, from_currency=equity.currency, to_currency=base_currency)
-                if value is not None:
-                    # Adjust for time value of money with the discount rate
-
-                    total_portfolio_value += value
-
-                    # Add the payout event to the schedule
-                    payout_schedule.append({
-                        "Equity": equity.name,
-                        "Ticker": equity.ticker,
-                        "Vesting Date": datetime.fromtimestamp(event.vesting_date),
-                        "Shares Vested": event.shares_vested,
-                        f"Value ({base_currency})": round(value, 2)
-                    })
+        report = get_cached_report(selected_portfolio, selected_method, base_currency, rates)
 
         # Display the payout schedule as a table
-        if payout_schedule:
-            payout_df = pd.DataFrame(payout_schedule)
-            # Ensure the vesting_date is sorted
-            payout_df = payout_df.sort_values(by='Vesting Date')
-            daily_payouts = payout_df.groupby('Vesting Date').agg({f'Value ({base_currency})': 'sum'}).reset_index()
-            daily_payouts.columns = ['Vesting Date', 'Amount Paid']
-            payout_df['Month'] = payout_df['Vesting Date'].dt.to_period('M')
-            monthly_payout_df = payout_df.groupby(['Month']).agg({
-                f'Value ({base_currency})': 'sum'
-            }).reset_index()
-            # Calculate cumulative payout
-            monthly_payout_df[f'Cumulative Payout ({base_currency})'] = monthly_payout_df[f'Value ({base_currency})'].cumsum()
-
-
+        if not report.payout_schedule.empty:
             # Plotting the cumulative payouts over time
-            if not payout_df.empty:
-                st.bar_chart(daily_payouts.set_index('Vesting Date'))
-                st.table(monthly_payout_df)
-
-        st.write(f"**Total Portfolio Value using '{selected_method}' method in {base_currency}:** {total_portfolio_value:,.2f} {base_currency}")
-
+            with span('render.payout_charts'):
+                # Dense schedules are summed into CHART_BAR_BUDGET time buckets, which keeps the total paid
+                st.bar_chart(bucket_sums(report.daily_payouts, 'Vesting Date', 'Amount Paid', CHART_BAR_BUDGET).set_index('Vesting Date'))
+                st.table(report.monthly_payouts.round(2))
+
+        st.write(f"**Total Portfolio Value using '{selected_method}' method in {base_currency}:** {report.total_value:,.2f} {base_currency}")
+
+        if simulate:
+            st.subheader("Simulated value of unvested shares")
+            with span('simulation.render'), st.spinner(f"Simulating {n_paths:,} price paths..."):
+                simulation = simulate_portfolio(selected_portfolio, rates, base_currency, n_paths=n_paths)
+            if simulation.event_percentiles.empty:
+                st.write("No vesting events after today.")
+            else:
+                st.write(f"Percentiles of the total value of the unvested shares in {base_currency} (mean {simulation.total_mean:,.2f}):")
+                st.table(simulation.total_percentiles.to_frame(f"Total ({base_currency})").T.round(2))
+                st.dataframe(simulation.event_percentiles.round(2), hide_index=True)
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import json
+import streamlit as st
+from typing import Optional
+from utils.lazy_import_helper import lazy_import
+from utils.perf_helper import Trace, finish_trace
+
+pd = lazy_import('pandas')
+
+MAX_STORED_TRACES = 20  # Traces of previous reruns kept per session for the panel and the export
+
+
+def display_perf_panel(trace: Optional[Trace]) -> None:
+    """
+    Finishes the rerun's trace and shows it, with the previous reruns of the session, in the sidebar.
+    Does nothing when instrumentation is disabled.
+    """
+    if trace is None:
+        return
+    finish_trace(trace)
+    traces = st.session_state.setdefault('perf_traces', [])
+    traces.append(trace.to_dict())
+    del traces[:-MAX_STORED_TRACES]
+
+    with st.sidebar.expander("Performance", expanded=False):
+        st.write(f"**{trace.name}** rerun took {trace.duration * 1000:,.0f} ms")
+
+        summary = trace.summary()
+        if summary:
+            st.dataframe(pd.DataFrame(summary).round(1), hide_index=True)
+        if trace.counters:
+            st.dataframe(
+                pd.DataFrame(sorted(trace.counters.items()), columns=['counter', 'count']),
+                hide_index=True
+            )
+
+        st.caption("Previous reruns")
+        st.dataframe(
+            pd.DataFrame([
+                {'rerun': stored['name'], 'started_at': stored['started_at'], 'duration_ms': round(stored['duration_ms'], 1)}
+                for stored in reversed(traces)
+            ]),
+            hide_index=True
+        )
+        st.download_button(
+            "Export traces (JSON)",
+            data=json.dumps(traces, indent=2),
+            file_name="perf_traces.json",
+            mime="application/json",
+        )
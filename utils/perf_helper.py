@@ -0,0 +1,145 @@
+"""
+Lightweight timing instrumentation for the app's hot paths.
+
+Spans and counters are only recorded while a trace is active in the current context (see `start_trace`).
+Without an active trace, `span`, `timed` and `count` cost a single context variable lookup.
+"""
+import os
+import json
+import time
+import threading
+import functools
+import contextvars
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Optional
+
+PERF_ENABLED_ENV = 'EQUITY_TRANSFERS_PERF'  # Set to 1 to record a trace for every rerun and show the sidebar panel
+PERF_LOG_ENV = 'EQUITY_TRANSFERS_PERF_LOG'  # Optional JSON lines file every finished trace is appended to
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_span_depth = contextvars.ContextVar('span_depth', default=0)
+_NULL_SPAN = nullcontext()
+
+
+class Trace:
+    """Spans and counters recorded during a single script rerun (or any other unit of work)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = datetime.now()
+        self.duration = None
+        self.spans = []  # (name, start offset, duration, depth, thread name)
+        self.counters = Counter()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, start: float, duration: float, depth: int) -> None:
+        with self._lock:
+            self.spans.append((name, start - self._start, duration, depth, threading.current_thread().name))
+
+    def add_count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += amount
+
+    def summary(self) -> list[dict]:
+        """Aggregates the spans by name, slowest total first."""
+        totals = {}
+        for name, _, duration, _, _ in self.spans:
+            calls, total, longest = totals.get(name, (0, 0.0, 0.0))
+            totals[name] = (calls + 1, total + duration, max(longest, duration))
+        return sorted(
+            ({'span': name, 'calls': calls, 'total_ms': total * 1000, 'max_ms': longest * 1000} for name, (calls, total, longest) in totals.items()),
+            key=lambda row: row['total_ms'], reverse=True
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'started_at': self.started_at.isoformat(),
+            'duration_ms': None if self.duration is None else self.duration * 1000,
+            'spans': [
+                {'name': name, 'start_ms': start * 1000, 'duration_ms': duration * 1000, 'depth': depth, 'thread': thread}
+                for name, start, duration, depth, thread in self.spans
+            ],
+            'counters': dict(self.counters),
+        }
+
+
+def is_perf_enabled() -> bool:
+    return os.environ.get(PERF_ENABLED_ENV, '').lower() in ('1', 'true', 'yes')
+
+def start_trace(name: str, force: bool = False) -> Optional[Trace]:
+    """
+    Starts recording a trace in the current context, if instrumentation is enabled (or `force` is set).
+
+    Returns:
+        Trace: The active trace, or None when instrumentation is disabled.
+    """
+    if not (force or is_perf_enabled()):
+        return None
+    trace = Trace(name)
+    _current_trace.set(trace)
+    return trace
+
+def finish_trace(trace: Optional[Trace]) -> Optional[Trace]:
+    """Stops recording the trace and appends it to the perf log file, if one is configured."""
+    if trace is None:
+        return None
+    trace.duration = time.perf_counter() - trace._start
+    if _current_trace.get() is trace:
+        _current_trace.set(None)
+
+    log_path = os.environ.get(PERF_LOG_ENV)
+    if log_path:
+        with open(log_path, 'a') as f:
+            f.write(json.dumps(trace.to_dict()) + '\n')
+    return trace
+
+def get_current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+@contextmanager
+def _record_span(trace: Trace, name: str):
+    depth = _span_depth.get()
+    token = _span_depth.set(depth + 1)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, time.perf_counter() - start, depth)
+        _span_depth.reset(token)
+
+def span(name: str):
+    """Context manager timing a block as a span of the active trace."""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NULL_SPAN
+    return _record_span(trace, name)
+
+def timed(name: Optional[str] = None):
+    """Decorator timing every call of a function as a span of the active trace (named module.function by default)."""
+    def decorate(func):
+        span_name = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _current_trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            with _record_span(trace, span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(name: str, amount: int = 1) -> None:
+    """Increments a counter of the active trace, e.g. network calls or cache hits and misses."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_count(name, amount)
+
+def propagate_context(func):
+    """Wraps a function so it runs in a copy of the caller's context, keeping the active trace in pool threads."""
+    context = contextvars.copy_context()
+    return functools.partial(context.run, func)
@@ -0,0 +1,427 @@
+import os
+import threading
+import json
+import sqlite3
+import numpy as np
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterable, Optional
+
+from utils.base_templates import Equity, Portfolio, PriceHistory
+from utils.cache_helper import LRUCache
+from utils.perf_helper import count, span, timed
+
+PORTFOLIOS_JSON_PATH = 'data/portfolios.json'
+PORTFOLIO_STORE_PATH = 'data/portfolios.sqlite'
+PRICE_SIDECAR_FOLDER = 'prices'  # Sidecar folder for historical prices, relative to the portfolio file / store
+
+_decoded_portfolios = LRUCache(max_size=32)  # (store path, name) -> ((version, updated_at, registry generation), Portfolio)
+_registered_prices = LRUCache(max_size=1024)  # Sidecar path -> PriceHistory shared by every portfolio holding the ticker
+_initialized_stores = set()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS portfolios (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tickers (
+    ticker TEXT PRIMARY KEY,
+    isin TEXT,
+    name TEXT,
+    currency TEXT,
+    latest_price REAL,
+    prices TEXT,
+    generation INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+REGISTRY_FIELDS = ('isin', 'name', 'currency', 'latest_price')  # Equity metadata stored once per ticker, with the prices
+
+def save_price_history_sidecar(price_history: PriceHistory, sidecar_dir: str) -> dict:
+    """
+    Writes a price history to a content addressed .npy sidecar and returns the reference stored in the JSON file.
+    """
+    sidecar = f"{PRICE_SIDECAR_FOLDER}/{price_history.content_hash()}.npy"
+    sidecar_path = os.path.join(sidecar_dir, sidecar)
+    if not os.path.exists(sidecar_path):  # Identical histories share a single sidecar
+        price_history.save(sidecar_path)
+    return {'sidecar': sidecar}
+
+def portfolio_to_dict(portfolio: Portfolio, sidecar_dir: str) -> dict:
+    """
+    Converts a portfolio to JSON compatible data, moving historical prices into sidecar files.
+    """
+    portfolio_data = portfolio.dict()
+    for equity_data in portfolio_data['equities'].values():
+        if equity_data['historical_prices'] is not None:
+            equity_data['historical_prices'] = save_price_history_sidecar(equity_data['historical_prices'], sidecar_dir)
+    return portfolio_data
+
+def portfolio_from_dict(portfolio_data: dict, sidecar_dir: str) -> Portfolio:
+    """
+    Loads a portfolio from JSON data. Historical prices may be sidecar references or legacy inline dictionaries.
+    """
+    return Portfolio.model_validate(portfolio_data, context={'sidecar_dir': sidecar_dir})
+
+def load_registered_prices(sidecar: str, sidecar_dir: str) -> PriceHistory:
+    """
+    Loads a registered price history. Sidecars are content addressed, so the loaded history never goes stale and
+    is shared by every portfolio (and every store session) referencing it.
+    """
+    sidecar_path = os.path.abspath(os.path.join(sidecar_dir, sidecar))
+    price_history = _registered_prices.get(sidecar_path)
+    if price_history is None:
+        count('cache.registered_prices.miss')
+        price_history = PriceHistory.load(sidecar_path)
+        _registered_prices.set(sidecar_path, price_history)
+    else:
+        count('cache.registered_prices.hit')
+    return price_history
+
+def merge_price_histories(stored: Optional[PriceHistory], new: Optional[PriceHistory]) -> Optional[PriceHistory]:
+    """
+    Returns the union of two price histories. On dates both have a price, the history ending last wins.
+    Empty histories are treated like missing ones.
+    """
+    if not stored:
+        return new or None
+    if not new or new.content_hash() == stored.content_hash():
+        return stored
+    newer, older = (new, stored) if new.timestamps[-1] >= stored.timestamps[-1] else (stored, new)
+    timestamps, first = np.unique(np.concatenate((newer.timestamps, older.timestamps)), return_index=True)
+    merged = PriceHistory(timestamps, np.concatenate((newer.prices, older.prices))[first])
+    return stored if merged == stored else merged
+
+def register_ticker(connection: sqlite3.Connection, equity: Equity, sidecar_dir: str) -> bool:
+    """
+    Merges an equity's prices and metadata into the shared ticker registry.
+
+    The metadata of whichever side has the most recent prices is kept, so saving a portfolio loaded before
+    a refresh never rolls the ticker back. The registered currency never changes: prices quoted in another
+    currency cannot be merged, so the equity is left out of the registry and False is returned.
+    """
+    row = connection.execute(
+        "SELECT isin, name, currency, latest_price, prices FROM tickers WHERE ticker = ?", (equity.ticker,)
+    ).fetchone()
+    if row is not None and None not in (row[2], equity.currency) and row[2] != equity.currency:
+        count('storage.registry.currency_conflict')
+        return False
+    stored_prices = load_registered_prices(row[4], sidecar_dir) if row is not None and row[4] else None
+    equity_prices = equity.historical_prices or None  # An empty history adds nothing, like a missing one
+    prices = merge_price_histories(stored_prices, equity_prices)
+
+    equity_metadata = tuple(getattr(equity, field) for field in REGISTRY_FIELDS)
+    stored_metadata = row[:len(REGISTRY_FIELDS)] if row is not None else (None,) * len(REGISTRY_FIELDS)
+    equity_is_newer = not stored_prices or (
+        equity_prices is not None and equity_prices.timestamps[-1] >= stored_prices.timestamps[-1]
+    )
+    first, second = (equity_metadata, stored_metadata) if equity_is_newer else (stored_metadata, equity_metadata)
+    metadata = tuple(value if value is not None else fallback for value, fallback in zip(first, second))
+    prices_sidecar = save_price_history_sidecar(prices, sidecar_dir)['sidecar'] if prices else None
+
+    if row is not None and (*metadata, prices_sidecar) == tuple(row):
+        return True  # Nothing new, portfolios holding the ticker keep their decoded copies
+    count('storage.registry.update')
+    connection.execute(
+        """
+        INSERT OR REPLACE INTO tickers (ticker, isin, name, currency, latest_price, prices, generation, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(generation), 0) + 1 FROM tickers), ?)
+        """,
+        (equity.ticker, *metadata, prices_sidecar, datetime.now().timestamp())
+    )
+    return True
+
+def portfolio_to_store_dict(connection: sqlite3.Connection, portfolio: Portfolio, sidecar_dir: str) -> dict:
+    """
+    Converts a portfolio to the stored format. Equities with a ticker are registered in the shared ticker registry
+    and stored as references holding only their name and vesting events. Other equities, and equities quoted in
+    another currency than their registered ticker, are stored in full.
+    """
+    portfolio_data = portfolio.dict()
+    for key, equity in portfolio.equities.items():
+        equity_data = portfolio_data['equities'][key]
+        if equity.ticker is None or not register_ticker(connection, equity, sidecar_dir):
+            if equity_data['historical_prices'] is not None:
+                equity_data['historical_prices'] = save_price_history_sidecar(equity_data['historical_prices'], sidecar_dir)
+            continue
+        portfolio_data['equities'][key] = {
+            'ticker': equity.ticker, 'registry': True, 'name': equity.name, 'vesting_events': equity_data['vesting_events']
+        }
+    return portfolio_data
+
+def resolve_registry_references(connection: sqlite3.Connection, portfolios_data: Iterable[dict], sidecar_dir: str) -> None:
+    """
+    Replaces the registry references of stored portfolios with the registered equity data, in place.
+    Every registered ticker is read once, however many of the portfolios hold it. Each portfolio keeps its
+    own name for the equity, so equities stay keyed by their name.
+    """
+    portfolios_data = list(portfolios_data)
+    tickers = sorted({
+        equity_data['ticker'] for portfolio_data in portfolios_data
+        for equity_data in portfolio_data['equities'].values() if equity_data.get('registry')
+    })
+    if not tickers:
+        return
+    rows = connection.execute(
+        "SELECT ticker, isin, name, currency, latest_price, prices FROM tickers WHERE ticker IN (SELECT value FROM json_each(?))",
+        (json.dumps(tickers),)
+    ).fetchall()
+    registered = {
+        ticker: {
+            'ticker': ticker,
+            **dict(zip(REGISTRY_FIELDS, metadata)),
+            'historical_prices': load_registered_prices(prices, sidecar_dir) if prices else None,
+        }
+        for ticker, *metadata, prices in rows
+    }
+
+    for portfolio_data in portfolios_data:
+        for key, equity_data in portfolio_data['equities'].items():
+            if equity_data.get('registry'):
+                portfolio_data['equities'][key] = {
+                    **registered.get(equity_data['ticker'], {'ticker': equity_data['ticker']}),
+                    'name': equity_data.get('name', key),  # References saved before names were stored are keyed by name
+                    'vesting_events': equity_data['vesting_events'],
+                }
+
+def get_stored_sidecars(connection: sqlite3.Connection, portfolio_name: str, tickers: Iterable[str]) -> set[str]:
+    """Returns the sidecars referenced by a stored portfolio and by the registry entries of the given tickers."""
+    rows = connection.execute(
+        """
+        SELECT prices FROM tickers WHERE ticker IN (SELECT value FROM json_each(:tickers)) AND prices IS NOT NULL
+        UNION
+        SELECT json_extract(equity.value, '$.historical_prices.sidecar')
+        FROM portfolios, json_each(portfolios.data, '$.equities') AS equity
+        WHERE portfolios.name = :name AND json_extract(equity.value, '$.historical_prices.sidecar') IS NOT NULL
+        """,
+        {'tickers': json.dumps(sorted(set(tickers))), 'name': portfolio_name}
+    ).fetchall()
+    return {sidecar for sidecar, in rows}
+
+def get_unreferenced_sidecars(connection: sqlite3.Connection, sidecars: Iterable[str]) -> list[str]:
+    """Returns the given sidecars that neither a registered ticker nor a stored portfolio references."""
+    unreferenced = []
+    for sidecar in sidecars:
+        referenced = connection.execute(
+            """
+            SELECT EXISTS (SELECT 1 FROM tickers WHERE prices = :sidecar) OR EXISTS (
+                SELECT 1 FROM portfolios, json_each(portfolios.data, '$.equities') AS equity
+                WHERE json_extract(equity.value, '$.historical_prices.sidecar') = :sidecar
+            )
+            """,
+            {'sidecar': sidecar}
+        ).fetchone()[0]
+        if not referenced:
+            unreferenced.append(sidecar)
+    return unreferenced
+
+def remove_unreferenced_sidecars(sidecars: Iterable[str], store_path: str) -> None:
+    """
+    Deletes the given sidecars unless a registered ticker or a stored portfolio still references them.
+
+    Called once the transaction dropping the references has committed, so a rolled back save never loses
+    its files. The references are checked again under the write lock, so no concurrent save can start
+    sharing a sidecar while it is deleted.
+    """
+    if not sidecars:
+        return
+    sidecar_dir = os.path.dirname(store_path)
+    with open_store(store_path) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        for sidecar in get_unreferenced_sidecars(connection, sidecars):
+            sidecar_path = os.path.abspath(os.path.join(sidecar_dir, sidecar))
+            _registered_prices.pop(sidecar_path)
+            if os.path.exists(sidecar_path):
+                os.remove(sidecar_path)
+                count('storage.sidecar.removed')
+
+def write_file_atomically(file_path: str, content: str) -> None:
+    """
+    Writes to a temporary file next to the target and renames it over the target, so readers never see a partial file.
+    """
+    temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, file_path)
+
+@timed('storage.save_portfolios_to_json')
+def save_portfolios_to_json(portfolios: dict[str, Portfolio], file_path: str=PORTFOLIOS_JSON_PATH) -> None:
+    sidecar_dir = os.path.dirname(file_path)
+    portfolios_data = {name: portfolio_to_dict(portfolio, sidecar_dir) for name, portfolio in portfolios.items()}
+    write_file_atomically(file_path, json.dumps(portfolios_data, indent=4))
+
+@timed('storage.load_portfolios_from_json')
+def load_portfolios_from_json(file_path: str=PORTFOLIOS_JSON_PATH) -> dict[str, Portfolio]:
+    with open(file_path, 'r') as json_file:
+        portfolios_data = json.load(json_file)
+    sidecar_dir = os.path.dirname(file_path)
+    return {name: portfolio_from_dict(data, sidecar_dir) for name, data in portfolios_data.items()}
+
+def get_legacy_json_path(store_path: str) -> Optional[str]:
+    """Returns the legacy JSON file seeding a new store. Only the default store is seeded, other stores start empty."""
+    if os.path.abspath(store_path) == os.path.abspath(PORTFOLIO_STORE_PATH) and os.path.exists(PORTFOLIOS_JSON_PATH):
+        return PORTFOLIOS_JSON_PATH
+    return None
+
+def store_exists(store_path: str=PORTFOLIO_STORE_PATH) -> bool:
+    """Whether the store has anything to read: it exists, or opening it would seed it from the legacy JSON file."""
+    return os.path.exists(store_path) or get_legacy_json_path(store_path) is not None
+
+@contextmanager
+def open_store(store_path: str=PORTFOLIO_STORE_PATH, legacy_json_path: Optional[str]=None):
+    """
+    Opens the portfolio store and runs the block in a single transaction, creating the store if needed.
+
+    A new store is seeded with the portfolios of `legacy_json_path`, by default the legacy JSON file
+    for the default store only. Every save is its own transaction, so concurrent sessions never see
+    (or leave behind) a partial write.
+    """
+    legacy_json_path = legacy_json_path or get_legacy_json_path(store_path)
+    store_key = os.path.abspath(store_path)
+    is_new_store = not os.path.exists(store_path)
+    os.makedirs(os.path.dirname(store_path) or '.', exist_ok=True)
+    connection = sqlite3.connect(store_path, timeout=30)
+    try:
+        if is_new_store:
+            connection.execute("PRAGMA journal_mode=WAL")  # Readers do not block the writer
+        if is_new_store or store_key not in _initialized_stores:
+            connection.executescript(SCHEMA)  # Also adds the tickers table to stores created before the registry
+            _initialized_stores.add(store_key)
+        if is_new_store and legacy_json_path and os.path.exists(legacy_json_path):
+            migrate_json_to_store(connection, legacy_json_path, os.path.dirname(store_path))
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+def migrate_json_to_store(connection: sqlite3.Connection, json_path: str, sidecar_dir: str) -> None:
+    with open(json_path, 'r') as json_file:
+        portfolios_data = json.load(json_file)
+    json_dir = os.path.dirname(json_path)
+    with connection:
+        for name, portfolio_data in portfolios_data.items():
+            # Re-save through the model so prices move to the ticker registry
+            portfolio = portfolio_from_dict(portfolio_data, json_dir)
+            connection.execute(
+                "INSERT OR IGNORE INTO portfolios (name, data, updated_at) VALUES (?, ?, ?)",
+                (name, json.dumps(portfolio_to_store_dict(connection, portfolio, sidecar_dir)), datetime.now().timestamp())
+            )
+
+@timed('storage.save_portfolio')
+def save_portfolio(portfolio: Portfolio, store_path: str=PORTFOLIO_STORE_PATH) -> None:
+    """
+    Saves a single portfolio, leaving every other portfolio in the store untouched.
+    The prices and metadata of its tickers are merged into the shared ticker registry, and the sidecars
+    this replaces are deleted once nothing references them.
+    """
+    sidecar_dir = os.path.dirname(store_path)
+    tickers = [equity.ticker for equity in portfolio.equities.values() if equity.ticker is not None]
+    with open_store(store_path) as connection:
+        connection.execute("BEGIN IMMEDIATE")  # Registry merges read then write, hold the write lock throughout
+        previous_sidecars = get_stored_sidecars(connection, portfolio.name, tickers)
+        data = json.dumps(portfolio_to_store_dict(connection, portfolio, sidecar_dir))
+        connection.execute(
+            """
+            INSERT INTO portfolios (name, data, version, updated_at) VALUES (?, ?, 1, ?)
+            ON CONFLICT(name) DO UPDATE SET data = excluded.data, version = version + 1, updated_at = excluded.updated_at
+            """,
+            (portfolio.name, data, datetime.now().timestamp())
+        )
+        replaced_sidecars = get_unreferenced_sidecars(connection, previous_sidecars)
+    remove_unreferenced_sidecars(replaced_sidecars, store_path)
+
+def delete_portfolio(portfolio_name: str, store_path: str=PORTFOLIO_STORE_PATH) -> None:
+    if not store_exists(store_path):
+        return
+    # Registered tickers are kept, they are shared with other portfolios and cost a single copy each
+    with open_store(store_path) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        previous_sidecars = get_stored_sidecars(connection, portfolio_name, [])
+        connection.execute("DELETE FROM portfolios WHERE name = ?", (portfolio_name,))
+        replaced_sidecars = get_unreferenced_sidecars(connection, previous_sidecars)
+    _decoded_portfolios.pop((store_path, portfolio_name))
+    remove_unreferenced_sidecars(replaced_sidecars, store_path)
+
+@timed('storage.load_portfolio_catalog')
+def load_portfolio_catalog(store_path: str=PORTFOLIO_STORE_PATH) -> list[dict]:
+    """
+    Lists the stored portfolios with summary metadata, without decoding any portfolio.
+
+    Returns:
+        list[dict]: One entry per portfolio with 'name', 'version', 'updated_at', 'equity_count',
+            'event_count' and 'tickers'. Empty if the store does not exist.
+    """
+    if not store_exists(store_path):
+        return []  # Reading never creates a store
+    with open_store(store_path) as connection:
+        rows = connection.execute(
+            """
+            SELECT name, version, updated_at,
+                (SELECT COUNT(*) FROM json_each(data, '$.equities')),
+                (SELECT COALESCE(SUM(json_array_length(value, '$.vesting_events')), 0) FROM json_each(data, '$.equities')),
+                (SELECT GROUP_CONCAT(json_extract(value, '$.ticker'), ',') FROM json_each(data, '$.equities'))
+            FROM portfolios ORDER BY rowid
+            """
+        ).fetchall()
+    return [
+        {
+            'name': name,
+            'version': version,
+            'updated_at': datetime.fromtimestamp(updated_at),
+            'equity_count': equity_count,
+            'event_count': event_count,
+            'tickers': tickers.split(',') if tickers else [],
+        }
+        for name, version, updated_at, equity_count, event_count, tickers in rows
+    ]
+
+@timed('storage.load_portfolio')
+def load_portfolio(portfolio_name: str, store_path: str=PORTFOLIO_STORE_PATH) -> Optional[Portfolio]:
+    """
+    Loads a single portfolio. Decoded portfolios are cached in memory until the stored row or the ticker
+    registry changes. Rows are identified by version and save time, as a recreated portfolio starts at version 1 again.
+
+    The returned portfolio is shared with other callers and sessions, treat it as read-only.
+    """
+    cache_key = (store_path, portfolio_name)
+    if not store_exists(store_path):
+        _decoded_portfolios.pop(cache_key)
+        return None  # Reading never creates a store
+    cached = _decoded_portfolios.get(cache_key)
+    sidecar_dir = os.path.dirname(store_path)
+    with open_store(store_path) as connection:
+        stamp = connection.execute(
+            "SELECT version, updated_at, (SELECT COALESCE(MAX(generation), 0) FROM tickers) FROM portfolios WHERE name = ?", (portfolio_name,)
+        ).fetchone()
+        if stamp is None:
+            _decoded_portfolios.pop(cache_key)
+            return None
+        if cached is not None and cached[0] == stamp:
+            count('cache.decoded_portfolio.hit')
+            return cached[1]
+        count('cache.decoded_portfolio.miss')
+        *stamp, data = connection.execute(
+            "SELECT version, updated_at, (SELECT COALESCE(MAX(generation), 0) FROM tickers), data FROM portfolios WHERE name = ?", (portfolio_name,)
+        ).fetchone()
+        portfolio_data = json.loads(data)
+        resolve_registry_references(connection, [portfolio_data], sidecar_dir)
+
+    with span('storage.decode_portfolio'):
+        portfolio = portfolio_from_dict(portfolio_data, sidecar_dir)
+    _decoded_portfolios.set(cache_key, (tuple(stamp), portfolio))
+    return portfolio
+
+@timed('storage.load_portfolios')
+def load_portfolios(store_path: str=PORTFOLIO_STORE_PATH) -> dict[str, Portfolio]:
+    if not store_exists(store_path):
+        return {}  # Reading never creates a store
+    sidecar_dir = os.path.dirname(store_path)
+    with open_store(store_path) as connection:
+        rows = connection.execute("SELECT name, data FROM portfolios ORDER BY rowid").fetchall()
+        portfolios_data = {name: json.loads(data) for name, data in rows}
+        resolve_registry_references(connection, portfolios_data.values(), sidecar_dir)
+    return {name: portfolio_from_dict(data, sidecar_dir) for name, data in portfolios_data.items()}
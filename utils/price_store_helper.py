@@ -0,0 +1,122 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+import numpy as np
+from datetime import datetime, timedelta
+from typing import Optional
+
+from utils.base_templates import PriceHistory
+
+PRICE_STORE_PATH = 'data/price_store.sqlite'
+INFO_TTL = timedelta(days=7)  # How long cached ticker metadata (name, currency, ISIN) stays valid
+PRICE_REFRESH_TTL = timedelta(minutes=15)  # Minimum time between two upstream price refreshes of a ticker
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS prices (
+    ticker TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    close REAL NOT NULL,
+    PRIMARY KEY (ticker, timestamp)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ticker_info (
+    ticker TEXT PRIMARY KEY,
+    name TEXT,
+    currency TEXT,
+    isin TEXT,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS price_refreshes (
+    ticker TEXT PRIMARY KEY,
+    refreshed_at REAL NOT NULL
+);
+"""
+
+_initialized_stores = set()
+
+@contextmanager
+def open_store(store_path: str=PRICE_STORE_PATH):
+    """
+    Opens the price store (creating it if needed) and runs the block in a single transaction.
+    A connection is opened per operation so the store can be used from several threads and sessions.
+    """
+    store_key = os.path.abspath(store_path)
+    if store_key not in _initialized_stores:
+        os.makedirs(os.path.dirname(store_path) or '.', exist_ok=True)
+    connection = sqlite3.connect(store_path, timeout=30)
+    try:
+        if store_key not in _initialized_stores:
+            connection.executescript(SCHEMA)
+            _initialized_stores.add(store_key)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+    
+def load_price_history(ticker: str, since: Optional[datetime]=None, store_path: str=PRICE_STORE_PATH) -> Optional[PriceHistory]:
+    """
+    Loads the stored closing prices of a ticker, optionally only those from `since` onwards.
+    """
+    since_timestamp = int(since.timestamp()) if since else np.iinfo(np.int64).min
+    with open_store(store_path) as connection:
+        rows = connection.execute(
+            "SELECT timestamp, close FROM prices WHERE ticker = ? AND timestamp >= ? ORDER BY timestamp",
+            (ticker, since_timestamp)
+        ).fetchall()
+    if not rows:
+        return None
+    records = np.array(rows, dtype=np.float64)
+    return PriceHistory(records[:, 0].astype(np.int64), records[:, 1])
+
+def get_last_price_timestamp(ticker: str, store_path: str=PRICE_STORE_PATH) -> Optional[int]:
+    with open_store(store_path) as connection:
+        (last_timestamp,) = connection.execute("SELECT MAX(timestamp) FROM prices WHERE ticker = ?", (ticker,)).fetchone()
+    return last_timestamp
+
+def save_prices(ticker: str, price_history: PriceHistory, store_path: str=PRICE_STORE_PATH) -> None:
+    """
+    Inserts (or overwrites) the given bars and records the refresh time, in a single transaction.
+    """
+    with open_store(store_path) as connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO prices (ticker, timestamp, close) VALUES (?, ?, ?)",
+            ((ticker, timestamp, price) for timestamp, price in price_history.items())
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO price_refreshes (ticker, refreshed_at) VALUES (?, ?)",
+            (ticker, datetime.now().timestamp())
+        )
+
+def is_price_refresh_due(ticker: str, ttl: timedelta=PRICE_REFRESH_TTL, store_path: str=PRICE_STORE_PATH) -> bool:
+    with open_store(store_path) as connection:
+        row = connection.execute("SELECT refreshed_at FROM price_refreshes WHERE ticker = ?", (ticker,)).fetchone()
+    return row is None or datetime.now().timestamp() - row[0] > ttl.total_seconds()
+
+def load_ticker_info(ticker: str, ttl: timedelta=INFO_TTL, store_path: str=PRICE_STORE_PATH) -> Optional[dict]:
+    """
+    Returns the cached metadata of a ticker, or None if it is missing or older than `ttl`.
+    """
+    with open_store(store_path) as connection:
+        row = connection.execute(
+            "SELECT name, currency, isin, fetched_at FROM ticker_info WHERE ticker = ?", (ticker,)
+        ).fetchone()
+    if row is None or datetime.now().timestamp() - row[3] > ttl.total_seconds():
+        return None
+    return {'name': row[0], 'currency': row[1], 'isin': row[2]}
+
+def save_ticker_info(ticker: str, info: dict, store_path: str=PRICE_STORE_PATH) -> None:
+    with open_store(store_path) as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO ticker_info (ticker, name, currency, isin, fetched_at) VALUES (?, ?, ?, ?, ?)",
+            (ticker, info.get('name'), info.get('currency'), info.get('isin'), datetime.now().timestamp())
+        )
+
+def get_refresh_start(ticker: str, store_path: str=PRICE_STORE_PATH) -> Optional[datetime]:
+    """
+    Returns the date to refresh a ticker's prices from, or None if nothing is stored yet.
+
+    The last stored bar is fetched again since it may have been an intraday (not yet closed) price.
+    """
+    last_timestamp = get_last_price_timestamp(ticker, store_path)
+    if last_timestamp is None:
+        return None
+    return datetime.fromtimestamp(last_timestamp).replace(hour=0, minute=0, second=0) - timedelta(days=1)
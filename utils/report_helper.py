@@ -0,0 +1,264 @@
+import json
+import hashlib
+import threading
+import pandas as pd
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field
+
+from utils.base_templates import Portfolio, PRICE_WINDOW_DAYS, calculate_event_values
+from utils.exchange_rates_helper import build_cross_rate_matrix, convert_with_cross_rates, convert_frame_to_base_currency
+from utils.cache_helper import LRUCache
+from utils.chart_helper import CHART_POINT_BUDGET, downsample_wide_frame
+from utils.perf_helper import count, timed
+
+REPORT_CACHE_SIZE = 64  # Reports kept in memory, shared by every session of the process
+_report_cache = LRUCache(max_size=REPORT_CACHE_SIZE)
+_incremental_reports = LRUCache(max_size=REPORT_CACHE_SIZE)  # (portfolio name, method, currency, rates) -> IncrementalReport
+
+
+class PortfolioReport(BaseModel):
+    """Valuation of a portfolio for one method and base currency, independent of how it is displayed."""
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    portfolio_name: str = Field(description='Name of the valued portfolio')
+    method: str = Field(description='Valuation method used')
+    base_currency: str = Field(description='Currency all values are expressed in')
+    payout_schedule: pd.DataFrame = Field(description='One row per vesting event, sorted by vesting date')
+    daily_payouts: pd.DataFrame = Field(description='Amount paid per vesting date')
+    monthly_payouts: pd.DataFrame = Field(description='Amount paid per month, with the cumulative payout')
+    total_value: float = Field(description='Total value of the portfolio in the base currency')
+
+
+def get_portfolio_cross_rates(portfolio: Portfolio, rates: dict, base_currency: str) -> pd.DataFrame:
+    """Builds the cross rate matrix covering every currency of the portfolio and the base currency."""
+    currencies = {equity.currency or 'USD' for equity in portfolio.equities.values()}
+    return build_cross_rate_matrix(rates, {'USD', base_currency, *currencies})
+
+@timed('report.build_price_chart_data')
+def build_price_chart_data(portfolio: Portfolio, cross_rates: pd.DataFrame, base_currency: str) -> pd.DataFrame:
+    """Returns the historical prices in the base currency, with dates as index and tickers as columns."""
+    # Build the date aligned wide frame in one go, each column converted to the base currency
+    columns = {}
+    for equity in portfolio.equities.values():
+        if equity.historical_prices:  # Ensure historical prices are available
+            prices = pd.Series(equity.historical_prices.prices, index=pd.to_datetime(equity.historical_prices.timestamps, unit='s'))
+            columns[equity.ticker] = convert_with_cross_rates(prices, cross_rates, from_currency=equity.currency, to_currency=base_currency)
+
+    if not columns:
+        return pd.DataFrame()
+    price_data = pd.DataFrame(columns).sort_index()
+    price_data.index.name, price_data.columns.name = 'Date', 'Ticker'
+    return price_data
+
+@timed('report.build_price_chart_points')
+def build_price_chart_points(portfolio: Portfolio, cross_rates: pd.DataFrame, base_currency: str, max_points: int = CHART_POINT_BUDGET) -> pd.DataFrame:
+    """
+    Returns the price chart downsampled to at most `max_points` per ticker, in long format
+    with the columns 'Date', 'Ticker' and 'Price (<base currency>)'.
+    """
+    price_data = build_price_chart_data(portfolio, cross_rates, base_currency)
+    return downsample_wide_frame(price_data, max_points, value_name=f'Price ({base_currency})')
+
+@timed('report.build_payout_schedule')
+def build_payout_schedule(portfolio: Portfolio, method: str, cross_rates: pd.DataFrame, base_currency: str, window: int = PRICE_WINDOW_DAYS) -> pd.DataFrame:
+    """Values every vesting event of the portfolio and returns the payout schedule in the base currency."""
+    # Value every vesting event of the portfolio in one pass
+    event_values = portfolio.calculate_event_values(method=method, window=window)
+    payout_df = event_values_to_payouts(event_values, cross_rates, base_currency)
+    # Ensure the vesting_date is sorted
+    return payout_df.sort_values(by='Vesting Date', kind='stable').reset_index(drop=True)
+
+def event_values_to_payouts(event_values: pd.DataFrame, cross_rates: pd.DataFrame, base_currency: str) -> pd.DataFrame:
+    """Converts event values (see `calculate_event_values`) into payout schedule rows in the base currency."""
+    event_values = event_values.dropna(subset=['value'])  # Skip events without an available price
+    event_values = convert_frame_to_base_currency(event_values, cross_rates, to_currency=base_currency)
+
+    return pd.DataFrame({
+        "Equity": event_values['equity'],
+        "Ticker": event_values['ticker'],
+        "Vesting Date": pd.to_datetime([datetime.fromtimestamp(vesting_date) for vesting_date in event_values['vesting_date'].tolist()]),
+        "Shares Vested": event_values['shares_vested'],
+        f"Value ({base_currency})": event_values['value'],
+    })
+
+@timed('report.summarize_payouts')
+def summarize_payouts(payout_df: pd.DataFrame, base_currency: str) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Aggregates a payout schedule into daily payouts and monthly (and cumulative) payouts."""
+    value_column = f'Value ({base_currency})'
+    daily_payouts = payout_df.groupby('Vesting Date').agg({value_column: 'sum'}).reset_index()
+    daily_payouts.columns = ['Vesting Date', 'Amount Paid']
+
+    monthly_payout_df = payout_df.assign(Month=payout_df['Vesting Date'].dt.to_period('M')).groupby(['Month']).agg({
+        value_column: 'sum'
+    }).reset_index()
+    # Calculate cumulative payout
+    monthly_payout_df[f'Cumulative Payout ({base_currency})'] = monthly_payout_df[value_column].cumsum()
+    return daily_payouts, monthly_payout_df
+
+@timed('report.value_portfolio')
+def value_portfolio(portfolio: Portfolio, method: str, base_currency: str, rates: dict, cross_rates: Optional[pd.DataFrame] = None) -> PortfolioReport:
+    """
+    Values a portfolio and aggregates its payouts.
+
+    Args:
+        portfolio (Portfolio): The portfolio to value.
+        method (str): One of 'latest', 'average' or 'moving_average'.
+        base_currency (str): The currency to express all values in.
+        rates (dict): A dictionary containing exchange rates.
+        cross_rates (pd.DataFrame): Optional precomputed cross rate matrix for the portfolio.
+
+    Returns:
+        PortfolioReport: The payout schedule, its daily and monthly aggregates and the total value.
+    """
+    if cross_rates is None:
+        cross_rates = get_portfolio_cross_rates(portfolio, rates, base_currency)
+    payout_df = build_payout_schedule(portfolio, method, cross_rates, base_currency)
+    daily_payouts, monthly_payouts = summarize_payouts(payout_df, base_currency)
+    return PortfolioReport(
+        portfolio_name=portfolio.name,
+        method=method,
+        base_currency=base_currency,
+        payout_schedule=payout_df,
+        daily_payouts=daily_payouts,
+        monthly_payouts=monthly_payouts,
+        total_value=float(payout_df[f'Value ({base_currency})'].sum()),
+    )
+
+def get_portfolio_content_hash(portfolio: Portfolio) -> str:
+    """
+    Returns a stable hash of everything a report depends on: the equities, their prices and their vesting events.
+    The portfolio name is left out, so identical portfolios share cached results.
+    """
+    digest = hashlib.sha1()
+    for key, equity in sorted(portfolio.equities.items()):
+        digest.update(json.dumps([
+            key, equity.ticker, equity.name, equity.currency, equity.latest_price,
+            equity.historical_prices.content_hash() if equity.historical_prices else None,
+            equity.vesting_events.content_hash(),
+        ]).encode())
+    return digest.hexdigest()
+
+def get_rates_version(rates: dict) -> str:
+    return hashlib.sha1(json.dumps(sorted(rates.items())).encode()).hexdigest()
+
+def get_cached(key: tuple, compute):
+    """Returns the cached result for the key, computing and caching it on a miss."""
+    result = _report_cache.get(key)
+    if result is None:
+        count('cache.report.miss')
+        result = compute()
+        _report_cache.set(key, result)
+    else:
+        count('cache.report.hit')
+    return result
+
+class IncrementalReport:
+    """
+    Payout schedule and daily / monthly rollups of one portfolio for a fixed method, base currency and rates.
+
+    Each update only revalues the equities modified since the previous update, and patches the rollups
+    by removing the old contributions of those equities and adding their new ones.
+    """
+
+    def __init__(self, method: str, base_currency: str, rates: dict, window: int = PRICE_WINDOW_DAYS):
+        self.method = method
+        self.base_currency = base_currency
+        self.rates = rates
+        self.window = window
+        self._fingerprints = {}  # Equity key -> valuation fingerprint at the last update
+        self._payouts = {}  # Equity key -> payout rows of the equity
+        self._daily = pd.DataFrame({'amount': pd.Series(dtype=float), 'count': pd.Series(dtype=int)})
+        self._monthly = self._daily.copy()
+        self._lock = threading.Lock()
+
+    def _apply(self, payouts: pd.DataFrame, sign: int) -> None:
+        """Adds (sign=1) or removes (sign=-1) the contribution of payout rows to the rollups."""
+        if payouts.empty:
+            return
+        values = payouts[f'Value ({self.base_currency})']
+        vesting_dates = payouts['Vesting Date']
+        for attribute, keys in (('_daily', vesting_dates), ('_monthly', vesting_dates.dt.to_period('M'))):
+            grouped = values.groupby(keys.to_numpy()).agg(['sum', 'count'])
+            rollup = getattr(self, attribute)
+            patched = pd.DataFrame({
+                'amount': rollup['amount'].add(sign * grouped['sum'], fill_value=0),
+                'count': rollup['count'].add(sign * grouped['count'], fill_value=0),
+            })
+            setattr(self, attribute, patched[patched['count'] > 0].sort_index())
+
+    @timed('report.incremental_update')
+    def update(self, portfolio: Portfolio) -> PortfolioReport:
+        with self._lock:
+            cross_rates = get_portfolio_cross_rates(portfolio, self.rates, self.base_currency)
+            modified, removed = portfolio.get_modified_equities(self._fingerprints)
+            count('report.equities_revalued', len(modified))
+
+            for key in [*removed, *modified]:
+                old_payouts = self._payouts.pop(key, None)
+                if old_payouts is not None:
+                    self._apply(old_payouts, -1)
+                self._fingerprints.pop(key, None)
+
+            for key in modified:
+                equity = portfolio.equities[key]
+                event_values = calculate_event_values([equity], method=self.method, window=self.window)
+                payouts = event_values_to_payouts(event_values, cross_rates, self.base_currency)
+                self._payouts[key] = payouts
+                self._fingerprints[key] = equity.get_valuation_fingerprint()
+                self._apply(payouts, 1)
+
+            return self._build_report(portfolio)
+
+    def _build_report(self, portfolio: Portfolio) -> PortfolioReport:
+        value_column = f'Value ({self.base_currency})'
+        frames = [self._payouts[key] for key in portfolio.equities if not self._payouts[key].empty]
+        if frames:
+            payout_df = pd.concat(frames, ignore_index=True).sort_values(by='Vesting Date', kind='stable').reset_index(drop=True)
+        else:
+            payout_df = pd.DataFrame(columns=['Equity', 'Ticker', 'Vesting Date', 'Shares Vested', value_column])
+
+        daily_payouts = pd.DataFrame({'Vesting Date': self._daily.index, 'Amount Paid': self._daily['amount'].to_numpy()})
+        monthly_payouts = pd.DataFrame({'Month': self._monthly.index, value_column: self._monthly['amount'].to_numpy()})
+        # Calculate cumulative payout
+        monthly_payouts[f'Cumulative Payout ({self.base_currency})'] = monthly_payouts[value_column].cumsum()
+
+        return PortfolioReport(
+            portfolio_name=portfolio.name,
+            method=self.method,
+            base_currency=self.base_currency,
+            payout_schedule=payout_df,
+            daily_payouts=daily_payouts,
+            monthly_payouts=monthly_payouts,
+            total_value=float(payout_df[value_column].sum()),
+        )
+
+def get_incremental_report(portfolio: Portfolio, method: str, base_currency: str, rates: dict) -> PortfolioReport:
+    """
+    Same as `value_portfolio`, but only revalues the equities modified since this portfolio was last valued
+    with the same method, base currency and rates.
+    """
+    key = (portfolio.name, method, base_currency, get_rates_version(rates))
+    incremental_report = _incremental_reports.get(key)
+    if incremental_report is None:
+        incremental_report = IncrementalReport(method, base_currency, rates)
+        _incremental_reports.set(key, incremental_report)
+    return incremental_report.update(portfolio)
+
+def get_cached_report(portfolio: Portfolio, method: str, base_currency: str, rates: dict) -> PortfolioReport:
+    """
+    Same as `value_portfolio`, but reuses reports already computed for the same portfolio and contents,
+    method, base currency and rates. The returned report is shared, treat it as read-only.
+    """
+    # The report carries the portfolio name (and comes from that portfolio's IncrementalReport), so it is part of the key
+    key = ('report', portfolio.name, get_portfolio_content_hash(portfolio), method, base_currency, get_rates_version(rates))
+    return get_cached(key, lambda: get_incremental_report(portfolio, method, base_currency, rates))
+
+def get_cached_price_chart_data(portfolio: Portfolio, base_currency: str, rates: dict, cross_rates: Optional[pd.DataFrame] = None, max_points: int = CHART_POINT_BUDGET) -> pd.DataFrame:
+    """
+    Same as `build_price_chart_points`, cached like `get_cached_report`. The returned frame is shared, treat it as read-only.
+    """
+    if cross_rates is None:
+        cross_rates = get_portfolio_cross_rates(portfolio, rates, base_currency)
+    key = ('price_chart', get_portfolio_content_hash(portfolio), base_currency, get_rates_version(rates), max_points)
+    return get_cached(key, lambda: build_price_chart_points(portfolio, cross_rates, base_currency, max_points))
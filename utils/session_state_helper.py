@@ -1,18 +1,6 @@
-import json
 import streamlit as st
 from utils.base_templates import Equity, Portfolio
-
-PORTFOLIOS_JSON_PATH = 'data/portfolios.json'
-
-def save_portfolios_to_json(portfolios: dict[str, Portfolio], file_path: str=PORTFOLIOS_JSON_PATH) -> None:
-    portfolios_data = {name: portfolio.dict() for name, portfolio in portfolios.items()}
-    with open(file_path, 'w') as json_file:
-        json.dump(portfolios_data, json_file, indent=4)
-
-def load_portfolios_from_json(file_path: str=PORTFOLIOS_JSON_PATH) -> dict[str, Portfolio]:
-    with open(file_path, 'r') as json_file:
-        portfolios_data = json.load(json_file)
-    return {name: Portfolio(**data) for name, data in portfolios_data.items()}
+from utils.portfolio_store_helper import delete_portfolio, save_portfolio
 
 
 def add_equity(equity: Equity) -> None:
@@ -22,6 +10,13 @@ def add_equity(equity: Equity) -> None:
     if equity.name not in st.session_state['current_portfolio'].equities:
         st.session_state['current_portfolio'].equities[equity.name] = equity
     
+def add_equities(equities) -> None:
+    """
+    Adds several equities to the current portfolio being created in one step.
+    """
+    for equity in equities:
+        add_equity(equity)
+
 def remove_equity(equity: Equity) -> None:
     """
     Removes an equity from the current portfolio being created.
@@ -34,7 +29,7 @@ def update_equity(shares_held: float, selected_portfolio: str, equity: Equity):
     Updates the number of shares held for a given equity in an existing portfolio.
     """
     st.session_state['portfolios'][selected_portfolio].equities[equity.name].shares_held = shares_held
-    save_portfolios_to_json(st.session_state['portfolios'], PORTFOLIOS_JSON_PATH)
+    save_portfolio(st.session_state['portfolios'][selected_portfolio])
 
 def add_portfolio() -> None:
     """
@@ -42,7 +37,7 @@ def add_portfolio() -> None:
     """
     portfolio = st.session_state['current_portfolio']
     st.session_state['portfolios'][portfolio.name] = portfolio
-    save_portfolios_to_json(st.session_state['portfolios'], PORTFOLIOS_JSON_PATH)
+    save_portfolio(portfolio)
 
 def remove_portfolio(portfolio_name: str) -> None:
     """
@@ -51,7 +46,7 @@ def remove_portfolio(portfolio_name: str) -> None:
     if portfolio_name in st.session_state['portfolios']:
         del st.session_state['portfolios'][portfolio_name]
         
-    save_portfolios_to_json(st.session_state['portfolios'], PORTFOLIOS_JSON_PATH)
+    delete_portfolio(portfolio_name)
     # Reset current portfolio if it was deleted
     if st.session_state['current_portfolio'].name == portfolio_name:
         st.session_state['current_portfolio'] = Portfolio(name='', equities={})
@@ -0,0 +1,323 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field
+
+from utils.base_templates import Portfolio
+from utils.report_helper import get_portfolio_cross_rates
+from utils.perf_helper import count, timed
+
+SIMULATION_PATHS = 100_000
+SIMULATION_PERCENTILES = (5, 25, 50, 75, 95)
+SIMULATION_CHUNK_ELEMENTS = 4_000_000  # Normal draws and simulated log prices held in memory at once
+SIMULATION_BLOCK_PATHS = 25_000  # Paths per independently seeded block, the unit of work of the process pool
+SIMULATION_HISTOGRAM_BINS = 1024  # Log price bins per (horizon, equity) pair, the percentiles are read from them
+SIMULATION_HISTOGRAM_WIDTH = 8.0  # Bins span the expected log price +/- this many standard deviations
+SIMULATION_PROCESS_THRESHOLD = 500_000  # Path count above which the blocks are spread over a process pool
+TRADING_DAYS_PER_YEAR = 252
+SECONDS_PER_DAY = 86400
+
+
+class SimulationResult(BaseModel):
+    """Distribution of the value of the unvested shares of a portfolio, in the base currency."""
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    portfolio_name: str = Field(description='Name of the simulated portfolio')
+    base_currency: str = Field(description='Currency all values are expressed in')
+    n_paths: int = Field(description='Number of simulated price paths')
+    as_of: datetime = Field(description='Only vesting events after this date are valued, paths start at the last price of each equity')
+    event_percentiles: pd.DataFrame = Field(description='One row per future vesting event with the mean and percentiles of its value')
+    total_percentiles: pd.Series = Field(description='Percentiles of the total value of all future vesting events')
+    total_mean: float = Field(description='Mean total value of all future vesting events')
+
+
+class SimulationInputs(BaseModel):
+    """Calibrated model of a portfolio, as plain arrays so it can be shipped to worker processes."""
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    factor: np.ndarray = Field(description='Matrix F (equities x draws) with F @ F.T the daily log return covariance')
+    grid_times: np.ndarray = Field(description='Sorted times (trading days) of every last price and vesting date, the simulation grid')
+    start_grid_index: np.ndarray = Field(description='Grid index of the last price of each equity, where its path starts')
+    pair_grid_index: np.ndarray = Field(description='Grid index of each (horizon, equity) pair with vesting events')
+    pair_equity: np.ndarray = Field(description='Equity of each pair')
+    pair_log_means: np.ndarray = Field(description='Expected log price of each pair')
+    pair_log_sds: np.ndarray = Field(description='Standard deviation of the log price of each pair, sets its histogram range')
+    pair_weights: np.ndarray = Field(description='Shares vested times the FX factor, summed over the events of each pair')
+
+
+class ChunkStatistics(BaseModel):
+    """Streaming statistics of simulated paths, merged across chunks so no pairs x paths array is ever kept."""
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    pair_counts: np.ndarray = Field(description='Histogram of the log price of each pair (pairs x bins)')
+    pair_sums: np.ndarray = Field(description='Sum of the simulated prices of each pair')
+    totals: np.ndarray = Field(description='Total value of every path')
+
+
+def calibrate_log_returns(price_series: list[pd.Series]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the mean and covariance matrix of the daily log returns of date indexed price series.
+
+    Series are aligned on their dates and the covariance uses every pair of overlapping returns, so
+    equities with shorter histories are still correlated with the others.
+    """
+    if not price_series:
+        return np.empty(0), np.empty((0, 0))
+
+    log_prices = pd.concat([np.log(series) for series in price_series], axis=1, ignore_index=True)
+    log_returns = log_prices.diff()
+    drifts = log_returns.mean().fillna(0.0).to_numpy()
+    covariance = log_returns.cov(min_periods=2).fillna(0.0).to_numpy()
+    return drifts, covariance
+
+def get_covariance_factor(covariance: np.ndarray) -> np.ndarray:
+    """
+    Returns F with F @ F.T == covariance: its Cholesky factor, or for the (possibly indefinite or singular)
+    pairwise estimates an eigendecomposition with the negative eigenvalues clipped and empty directions dropped.
+    """
+    try:
+        return np.linalg.cholesky(covariance)
+    except np.linalg.LinAlgError:
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        keep = eigenvalues > max(eigenvalues.max(initial=0.0), 0.0) * 1e-12
+        return eigenvectors[:, keep] * np.sqrt(eigenvalues[keep])
+
+def to_trading_days(timestamps) -> np.ndarray:
+    """Calendar time expressed in trading days, the unit the returns are calibrated in."""
+    return np.asarray(timestamps, dtype=np.float64) / SECONDS_PER_DAY * TRADING_DAYS_PER_YEAR / 365
+
+@timed('simulation.prepare')
+def prepare_simulation(portfolio: Portfolio, rates: dict, base_currency: str = 'USD', as_of: Optional[datetime] = None) -> tuple[SimulationInputs, pd.DataFrame]:
+    """
+    Calibrates the model of every equity of the portfolio and lists the vesting events after `as_of`.
+
+    Each equity's path starts at its latest price on the date of its last stored price, so the time between
+    that price and the vesting date is simulated in full. Equities with a single price are simulated at a
+    constant price, equities without any price are skipped.
+
+    Returns:
+        The simulation inputs, and the valued vesting events with their (horizon, equity) pair index
+        and their weight (shares vested times the FX factor).
+    """
+    as_of = as_of or datetime.now()
+    as_of_timestamp = int(as_of.timestamp())
+    cross_rates = get_portfolio_cross_rates(portfolio, rates, base_currency)
+
+    price_series, start_prices, start_timestamps, event_frames = [], [], [], []
+    for equity in portfolio.equities.values():
+        timestamps, prices = equity._get_price_arrays()
+        start_price = equity.latest_price or (float(prices[-1]) if len(prices) else None)
+        if not start_price:
+            continue
+
+        vesting_timestamps = equity.vesting_events.vesting_dates
+        shares_vested = equity.vesting_events.shares_vested
+        is_future = vesting_timestamps > as_of_timestamp
+        if not is_future.any():
+            continue
+
+        equity_index = len(start_prices)
+        start_prices.append(start_price)
+        start_timestamps.append(int(timestamps[-1]) if len(timestamps) else as_of_timestamp)
+        price_series.append(pd.Series(prices, index=timestamps // SECONDS_PER_DAY))
+        fx_factor = cross_rates.loc[equity.currency or 'USD', base_currency]
+        event_frames.append(pd.DataFrame({
+            'Equity': equity.name,
+            'Ticker': equity.ticker,
+            'Vesting Date': pd.to_datetime([datetime.fromtimestamp(vesting_date) for vesting_date in vesting_timestamps[is_future].tolist()]),
+            'Shares Vested': shares_vested[is_future],
+            'equity_index': equity_index,
+            'weight': shares_vested[is_future] * fx_factor,
+            'timestamp': vesting_timestamps[is_future],
+        }))
+
+    drifts, covariance = calibrate_log_returns(price_series)
+    if event_frames:
+        events = pd.concat(event_frames, ignore_index=True).sort_values('Vesting Date', kind='stable', ignore_index=True)
+    else:
+        events = pd.DataFrame(columns=['Equity', 'Ticker', 'Vesting Date', 'Shares Vested', 'equity_index', 'weight', 'timestamp'])
+
+    # Events vesting the same equity on the same day share their simulated price, the model being daily
+    # also keeps the simulation grid to at most one time per day
+    event_equities = events['equity_index'].to_numpy(dtype=np.int64)
+    start_times = to_trading_days(start_timestamps)
+    event_days = events['timestamp'].to_numpy(dtype=np.int64) // SECONDS_PER_DAY * SECONDS_PER_DAY
+    event_times = np.maximum(to_trading_days(event_days), start_times[event_equities])
+    pairs = pd.DataFrame({'time': event_times, 'equity': event_equities, 'weight': events['weight'].to_numpy(dtype=float)})
+    grouped = pairs.groupby(['time', 'equity'], sort=True)
+    events['pair_index'] = grouped.ngroup().to_numpy()
+    pair_weights = grouped['weight'].sum()
+    pair_times = pair_weights.index.get_level_values('time').to_numpy(dtype=np.float64)
+    pair_equities = pair_weights.index.get_level_values('equity').to_numpy(dtype=np.int64)
+
+    # Every equity is driven by the same correlated Brownian increments between consecutive grid times
+    grid_times, grid_index = np.unique(np.concatenate((start_times, pair_times)), return_inverse=True)
+    factor = get_covariance_factor(covariance) if len(covariance) else np.empty((0, 0))
+    elapsed = pair_times - start_times[pair_equities]
+    inputs = SimulationInputs(
+        factor=factor,
+        grid_times=grid_times,
+        start_grid_index=grid_index[:len(start_times)],
+        pair_grid_index=grid_index[len(start_times):],
+        pair_equity=pair_equities,
+        pair_log_means=np.log(np.array(start_prices, dtype=float))[pair_equities] + drifts[pair_equities] * elapsed,
+        pair_log_sds=np.sqrt(np.einsum('ij,ij->i', factor, factor)[pair_equities] * elapsed) if len(factor) else np.zeros(len(elapsed)),
+        pair_weights=pair_weights.to_numpy(dtype=float),
+    )
+    return inputs, events.drop(columns=['equity_index', 'timestamp'])
+
+def get_histogram_edges(inputs: SimulationInputs, bins: int = SIMULATION_HISTOGRAM_BINS) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the lowest log price and the bin width of the histogram of each pair."""
+    half_range = np.maximum(inputs.pair_log_sds * SIMULATION_HISTOGRAM_WIDTH, 1e-9)
+    return inputs.pair_log_means - half_range, 2 * half_range / bins
+
+def simulate_chunk(inputs: SimulationInputs, n_paths: int, rng: np.random.Generator, bins: int = SIMULATION_HISTOGRAM_BINS) -> ChunkStatistics:
+    """
+    Simulates `n_paths` correlated geometric Brownian motion paths on the grid times, O(equities x grid times)
+    per path, and reduces them to the histogram and sum of the price of every (horizon, equity) pair.
+    """
+    n_equities, n_draws = inputs.factor.shape
+    n_grid = len(inputs.grid_times)
+
+    # Brownian motion of every equity at every grid time (grid x paths x equities), from the cumulative sum of
+    # the increments. Paths come in antithetic pairs (z, -z), which halves the normal draws and reduces the variance.
+    brownian = np.zeros((n_grid, n_paths, n_equities), dtype=np.float32)
+    if n_draws and n_grid > 1:
+        increments = brownian[1:]
+        n_drawn = (n_paths + 1) // 2
+        draws = rng.standard_normal((n_grid - 1, n_drawn, n_draws), dtype=np.float32)
+        np.matmul(draws, inputs.factor.T.astype(np.float32), out=increments[:, :n_drawn])
+        del draws
+        np.negative(increments[:, :n_paths - n_drawn], out=increments[:, n_drawn:])
+        increments *= np.sqrt(np.diff(inputs.grid_times)).astype(np.float32)[:, None, None]
+        for grid_index in range(1, n_grid):  # Row by row, much faster than an in-place cumsum over the first axis
+            np.add(brownian[grid_index], brownian[grid_index - 1], out=brownian[grid_index])
+
+    # Each pair moves from the start of its equity's path (its last price) to its vesting date (pairs x paths)
+    start_index = inputs.start_grid_index[inputs.pair_equity]
+    log_prices = brownian[inputs.pair_grid_index, :, inputs.pair_equity].astype(np.float64)
+    log_prices -= brownian[start_index, :, inputs.pair_equity]
+    del brownian
+    log_prices += inputs.pair_log_means[:, None]
+
+    lows, widths = get_histogram_edges(inputs, bins)
+    bin_index = np.clip(((log_prices - lows[:, None]) / widths[:, None]).astype(np.int64), 0, bins - 1)
+    bin_index += (np.arange(len(lows)) * bins)[:, None]
+    pair_counts = np.bincount(bin_index.ravel(), minlength=len(lows) * bins).reshape(len(lows), bins)
+    del bin_index
+
+    pair_prices = np.exp(log_prices, out=log_prices)
+    return ChunkStatistics(pair_counts=pair_counts, pair_sums=pair_prices.sum(axis=1), totals=inputs.pair_weights @ pair_prices)
+
+def merge_statistics(statistics: list[ChunkStatistics]) -> ChunkStatistics:
+    return ChunkStatistics(
+        pair_counts=np.sum([chunk.pair_counts for chunk in statistics], axis=0),
+        pair_sums=np.sum([chunk.pair_sums for chunk in statistics], axis=0),
+        totals=np.concatenate([chunk.totals for chunk in statistics]),
+    )
+
+def simulate_block(inputs: SimulationInputs, n_paths: int, seed: np.random.SeedSequence) -> ChunkStatistics:
+    """
+    Simulates a block of paths with its own seed, in chunks of at most SIMULATION_CHUNK_ELEMENTS values.
+    The chunk size only depends on the portfolio, so the result only depends on the seed.
+    """
+    n_equities, n_draws = inputs.factor.shape
+    n_grid = len(inputs.grid_times)
+    values_per_path = max(n_grid * max(n_equities, n_draws), len(inputs.pair_weights) * 3, 1)
+    chunk_paths = max(1, SIMULATION_CHUNK_ELEMENTS // values_per_path)
+    rng = np.random.default_rng(seed)
+    block = None
+    totals = []
+    for start in range(0, n_paths, chunk_paths):
+        chunk = simulate_chunk(inputs, min(chunk_paths, n_paths - start), rng)
+        totals.append(chunk.totals)
+        if block is None:
+            block = chunk
+        else:  # A single histogram is kept, whatever the number of chunks
+            block.pair_counts += chunk.pair_counts
+            block.pair_sums += chunk.pair_sums
+    count('simulation.chunks', len(totals))
+    block.totals = np.concatenate(totals)
+    return block
+
+def _simulate_block_args(args):
+    return simulate_block(*args)
+
+def get_histogram_percentiles(inputs: SimulationInputs, pair_counts: np.ndarray, percentiles) -> np.ndarray:
+    """Reads the percentiles of the price of every pair from its log price histogram (pairs x percentiles)."""
+    lows, widths = get_histogram_edges(inputs, pair_counts.shape[1])
+    cumulative = np.cumsum(pair_counts, axis=1)
+    n_paths = cumulative[:, -1]
+    result = np.empty((len(lows), len(percentiles)))
+    rows = np.arange(len(lows))
+    for column, percentile in enumerate(percentiles):
+        target = n_paths * percentile / 100
+        bin_index = np.minimum((cumulative < target[:, None]).sum(axis=1), pair_counts.shape[1] - 1)
+        below = np.where(bin_index > 0, cumulative[rows, bin_index - 1], 0)
+        fraction = np.clip((target - below) / np.maximum(pair_counts[rows, bin_index], 1), 0.0, 1.0)
+        result[:, column] = np.exp(lows + (bin_index + fraction) * widths)  # Linear within the bin
+    return result
+
+@timed('simulation.simulate_portfolio')
+def simulate_portfolio(
+    portfolio: Portfolio,
+    rates: dict,
+    base_currency: str = 'USD',
+    n_paths: int = SIMULATION_PATHS,
+    percentiles=SIMULATION_PERCENTILES,
+    as_of: Optional[datetime] = None,
+    seed: Optional[int] = None,
+    max_workers: Optional[int] = None,
+) -> SimulationResult:
+    """
+    Monte Carlo valuation of the vesting events after `as_of`, under correlated geometric Brownian motions
+    calibrated on the historical prices of each equity. FX rates are held at their current value.
+
+    Paths are simulated in blocks of SIMULATION_BLOCK_PATHS, each with its own seed and spread over a process pool
+    above SIMULATION_PROCESS_THRESHOLD paths, so results only depend on `seed`. Blocks are reduced to histograms
+    of the price of every (horizon, equity) pair as they are simulated: memory depends on the number of pairs,
+    not on the number of paths, except for the total value of every path.
+    """
+    as_of = as_of or datetime.now()
+    inputs, events = prepare_simulation(portfolio, rates, base_currency, as_of=as_of)
+    percentile_columns = [f'P{percentile:g}' for percentile in percentiles]
+
+    if events.empty:
+        return SimulationResult(
+            portfolio_name=portfolio.name, base_currency=base_currency, n_paths=n_paths, as_of=as_of,
+            event_percentiles=events.drop(columns=['pair_index', 'weight']).assign(Mean=pd.Series(dtype=float), **{column: pd.Series(dtype=float) for column in percentile_columns}),
+            total_percentiles=pd.Series(0.0, index=percentile_columns), total_mean=0.0,
+        )
+
+    block_sizes = [min(SIMULATION_BLOCK_PATHS, n_paths - start) for start in range(0, n_paths, SIMULATION_BLOCK_PATHS)]
+    block_seeds = np.random.SeedSequence(seed).spawn(len(block_sizes))
+    block_args = [(inputs, size, block_seed) for size, block_seed in zip(block_sizes, block_seeds)]
+
+    if n_paths > SIMULATION_PROCESS_THRESHOLD and max_workers != 1 and len(block_args) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            statistics = merge_statistics(list(executor.map(_simulate_block_args, block_args)))
+    else:
+        statistics = merge_statistics([simulate_block(*args) for args in block_args])
+
+    # An event value is its shares times the FX factor times the pair price, a positive scaling,
+    # so its percentiles are the scaled percentiles of the pair price
+    pair_percentiles = get_histogram_percentiles(inputs, statistics.pair_counts, percentiles)
+    pair_means = statistics.pair_sums / n_paths
+    scale = events['weight'].to_numpy(dtype=float)
+
+    event_percentiles = events.drop(columns=['pair_index', 'weight'])
+    pair_index = events['pair_index'].to_numpy()
+    event_percentiles['Mean'] = pair_means[pair_index] * scale
+    event_percentiles[percentile_columns] = pair_percentiles[pair_index] * scale[:, None]
+
+    return SimulationResult(
+        portfolio_name=portfolio.name,
+        base_currency=base_currency,
+        n_paths=n_paths,
+        as_of=as_of,
+        event_percentiles=event_percentiles,
+        total_percentiles=pd.Series(np.percentile(statistics.totals, percentiles), index=percentile_columns),
+        total_mean=float(statistics.totals.mean()),
+    )
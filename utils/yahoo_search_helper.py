@@ -1,31 +1,76 @@
-import pandas as pd
-import requests
-import yfinance as yf
+from __future__ import annotations
+
+import re
+import functools
+from typing import Optional
+from datetime import datetime, timedelta
 import streamlit as st
-from streamlit_extras.stylable_container import stylable_container
-from streamlit_searchbox import st_searchbox
 
 from utils.base_templates import Equity
-from utils.session_state_helper import add_equity
-
-
-def make_search_callout(search_string: str) -> str:
-    url = 'https://query1.finance.yahoo.com/v1/finance/search'
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.109 Safari/537.36',
-    }
-    params = dict(
-        q=search_string,
-        quotesCount=10,
-        newsCount=0,
-        listsCount=0,
-        quotesQueryId='tss_match_phrase_query'
-    )
-    resp = requests.get(url=url, headers=headers, params=params)
-    data = resp.json()
-    if "quotes" not in data: # No results found
-        return {}
-    return data["quotes"]
+from utils.cache_helper import LRUCache
+from utils.fetch_helper import run_fetches
+from utils.market_data_helper import SEARCH_QUOTES_COUNT, get_provider
+from utils.perf_helper import count, span, timed
+from utils.price_store_helper import (
+    get_refresh_start, is_price_refresh_due, load_price_history, load_ticker_info, save_prices, save_ticker_info
+)
+from utils.session_state_helper import add_equity, add_equities
+
+SEARCH_DEBOUNCE_MS = 250  # Searchbox waits this long after the last keystroke before searching
+_search_cache = LRUCache(max_size=1024, ttl=15 * 60)  # Normalized query -> quotes
+
+HISTORY_DAYS = 365  # Days of price history attached to a new equity
+BULK_LOAD_WORKERS = 8  # Maximum number of tickers fetched at the same time by the bulk loader
+
+
+def normalize_search_query(search_string: str) -> str:
+    return " ".join((search_string or "").lower().split())
+
+def filter_cached_prefix_results(query: str) -> Optional[list]:
+    """
+    Reuses the cached results of a shorter prefix of the query, e.g. "micr" when typing "micro".
+
+    Only complete result sets (fewer quotes than requested) are reused, since a truncated
+    result set may be missing quotes that match the longer query.
+    """
+    for prefix_length in range(len(query) - 1, 0, -1):
+        cached_quotes = _search_cache.get(query[:prefix_length])
+        if cached_quotes is None:
+            continue
+        if len(cached_quotes) >= SEARCH_QUOTES_COUNT:
+            return None
+        return [
+            quote for quote in cached_quotes
+            if any(query in str(quote.get(field, "")).lower() for field in ("symbol", "shortname", "longname"))
+        ]
+    return None
+
+@timed('yahoo.fetch_search_quotes')
+def fetch_search_quotes(query: str) -> list:
+    return get_provider().search_quotes(query)
+
+@timed('yahoo.make_search_callout')
+def make_search_callout(search_string: str) -> list:
+    """
+    Searches Yahoo Finance for quotes, reusing cached results (or cached results of a prefix) when possible.
+
+    Identical queries issued concurrently by several sessions share a single upstream request (see `GuardedProvider`).
+    """
+    query = normalize_search_query(search_string)
+    if not query:
+        return []
+
+    cached_quotes = _search_cache.get(query)
+    if cached_quotes is None:
+        cached_quotes = filter_cached_prefix_results(query)
+    if cached_quotes is not None:
+        count('cache.search.hit')
+        return cached_quotes
+    count('cache.search.miss')
+
+    quotes = fetch_search_quotes(query)
+    _search_cache.set(query, quotes)
+    return quotes
 
 def search_yahoo_finance(search_term: str) -> list[tuple[str, str]]:
     candidates = make_search_callout(search_term)
@@ -45,6 +90,10 @@ def search_yahoo_finance(search_term: str) -> list[tuple[str, str]]:
     return formatted_results
 
 def search_functionality(key: str,) -> None:
+    # Component libraries are imported on first render, after the rest of the page has been sent
+    from streamlit_extras.stylable_container import stylable_container
+    from streamlit_searchbox import st_searchbox
+
     with stylable_container(
         key=f"container_equity_searchbox_{key}",
         css_styles="""
@@ -58,31 +107,131 @@ def search_functionality(key: str,) -> None:
             key="equity_searchbox_" + key,
             clear_on_submit=True,
             placeholder="Search Equities...",
+            debounce=SEARCH_DEBOUNCE_MS,
         )
     
     if selected_value is not None:
         selected_equity = get_equity_from_ticker(selected_value)
         add_equity(selected_equity)
 
+def bulk_search_functionality(key: str) -> None:
+    """
+    Lets the user paste a list of tickers and adds all of them to the current portfolio in one step.
+    """
+    tickers_text = st.text_area(
+        "Add several tickers at once",
+        key="bulk_tickers_" + key,
+        placeholder="AAPL, MSFT, 7203.T ...",
+    )
+    if st.button("Add Tickers", key="bulk_add_" + key):
+        tickers = parse_tickers(tickers_text)
+        if not tickers:
+            st.warning("Enter at least one ticker.")
+            return
+
+        progress_bar = st.progress(0.0, text=f"Loading {len(tickers)} tickers...")
+        def update_progress(completed: int, total: int, ticker: str) -> None:
+            progress_bar.progress(completed / total, text=f"Loaded {ticker} ({completed}/{total})")
+
+        equities, errors = get_equities_from_tickers(tickers, on_progress=update_progress)
+        add_equities(equities.values())
+        progress_bar.empty()
+
+        if equities:
+            st.success(f"Added {len(equities)} of {len(tickers)} tickers.")
+        for ticker, error in errors.items():
+            st.warning(f"Could not load {ticker}: {error}")
+
+def parse_tickers(tickers_text: str) -> list[str]:
+    """Splits comma, semicolon or whitespace separated tickers, dropping duplicates but keeping their order."""
+    tickers = (ticker.upper() for ticker in re.split(r"[,;\s]+", tickers_text or "") if ticker)
+    return list(dict.fromkeys(tickers))
+
+@timed('yahoo.get_equities_from_tickers')
+def get_equities_from_tickers(tickers: list[str], max_workers: int = BULK_LOAD_WORKERS, on_progress=None) -> tuple[dict[str, Equity], dict[str, str]]:
+    """
+    Loads several tickers concurrently. Each ticker's requests have their own timeouts and retries
+    (see `get_equity_from_ticker`), so a failed ticker is not retried again as a whole.
+
+    Args:
+        tickers (list[str]): The tickers to load.
+        max_workers (int): Maximum number of tickers fetched at the same time.
+        on_progress (callable): Optional callback called as on_progress(completed, total, ticker)
+            from the calling thread after each ticker finishes.
+
+    Returns:
+        tuple[dict[str, Equity], dict[str, str]]: The loaded equities and the error message of
+            every ticker that failed, both keyed by ticker in the requested order.
+    """
+    def on_result(outcome, completed, total):
+        if on_progress is not None:
+            on_progress(completed, total, outcome.key)
+
+    # Results come back in the order the tickers were requested. Retries and timeouts are left to the
+    # inner fetches, retrying here as well would multiply the upstream calls of a failing ticker
+    report = run_fetches(
+        {ticker: functools.partial(get_equity_from_ticker, ticker) for ticker in dict.fromkeys(tickers)},
+        concurrency=max_workers,
+        timeout=None,
+        retries=0,
+        on_result=on_result,
+    )
+    return report.values, report.errors
+
+def refresh_ticker_prices(ticker: str) -> None:
+    """Fetches the bars missing from the local price store (a full year for unknown tickers) and saves them."""
+    refresh_start = get_refresh_start(ticker)
+    with span('yahoo.history'):
+        price_history = get_provider().get_history(ticker, refresh_start.date() if refresh_start else None)
+    if len(price_history):
+        save_prices(ticker, price_history)
+
+def fetch_ticker_info(ticker: str) -> dict:
+    """Fetches the name, currency and ISIN of a ticker and caches them in the price store."""
+    with span('yahoo.info'):
+        info = get_provider().get_ticker_info(ticker)
+    save_ticker_info(ticker, info)
+    return info
+
+@timed('yahoo.get_equity_from_ticker')
 def get_equity_from_ticker(ticker_str: str) -> Equity:
-    ticker = yf.Ticker(ticker_str)
+    fetches = {}
+
+    # Only fetch the bars missing from the local price store
+    if is_price_refresh_due(ticker_str):
+        count('cache.price_store.miss')
+        fetches['history'] = functools.partial(refresh_ticker_prices, ticker_str)
+    else:
+        count('cache.price_store.hit')
 
-    # Fetch historical data for the last 1 year
-    history = ticker.history(period="1y")  # 'Close' prices for 1 year
+    # Metadata rarely changes, reuse the cached name, currency and ISIN until they expire
+    info = load_ticker_info(ticker_str)
+    if info is None:
+        count('cache.ticker_info.miss')
+        fetches['info'] = functools.partial(fetch_ticker_info, ticker_str)
+    else:
+        count('cache.ticker_info.hit')
 
-    # Convert historical close prices to a pandas Series with dates as index
-    historical_prices_series = history['Close']
+    # Price history and metadata are fetched concurrently
+    report = run_fetches(fetches)
+    if 'history' in report.errors:
+        print(f"Error refreshing prices of {ticker_str}, using stored prices: {report.errors['history']}")
+    if 'info' in report.errors:
+        raise RuntimeError(f"Could not load the details of {ticker_str}: {report.errors['info']}")
+    info = report.values.get('info', info)
 
-    # Convert Series to dictionary with timestamps
-    historical_prices_dict = historical_prices_series.rename_axis('Date').rename(lambda x: int(x.timestamp())).to_dict()
+    # Read the last year of closing prices back from the store
+    historical_prices = load_price_history(ticker_str, since=datetime.now() - timedelta(days=HISTORY_DAYS))
+    if historical_prices is None:
+        raise ValueError(f"No price history available for {ticker_str}")
 
     equity = Equity(
-        isin=ticker.isin,
+        isin=info['isin'],
         ticker=ticker_str,
-        name=ticker.info.get("shortName") or ticker.info.get("longName", None),
-        currency=ticker.info.get('currency', None),
-        latest_price=historical_prices_series.iloc[-1],  # Last available close price
-        historical_prices=historical_prices_dict,  # Convert Series to dict
+        name=info['name'],
+        currency=info['currency'],
+        latest_price=historical_prices.prices[-1],  # Last available close price
+        historical_prices=historical_prices,
         shares_held=0  # Placeholder for number of shares
     )
-    return equity
\ No newline at end of file
+    return equity